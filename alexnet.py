@@ -1,16 +1,34 @@
 import tensorflow as tf
-import numpy as np
+
+from weight_mask import as_bool
+from weight_store import LAYER_NAMES, default_weights_path, load_weights_dict
+
+# how conv implements groups > 1: 'split' convolves every group separately
+# and concatenates, 'block_diagonal' runs one conv with a block diagonal kernel
+GROUP_CONV_MODES = ['split', 'block_diagonal']
+
+# fused: conv without the no-op reshape after the bias, so that Conv2D +
+# BiasAdd + Relu are adjacent ops the runtime's graph optimizer can fuse. The
+# fc layers are the same MatMul -> BiasAdd -> Relu ops either way
 
 class AlexNet(object):
-    def __init__ (self, x, keep_prob, num_classes, weights_path = 'DEFAULT'):
+    def __init__ (self, x, keep_prob, num_classes, weights_path = 'DEFAULT',
+                  group_conv = 'split', fused = False):
         # -x: tf.placeholder
+        # -group_conv: one of GROUP_CONV_MODES
+        # -fused: build the graph optimized conv layers
         self.X = x
+        self.GROUP_CONV = group_conv
+        self.FUSED = fused
         self.NUM_CLASSES = num_classes
         self.KEEP_PROB = keep_prob
         self.layer_names = []
+        self.weight_assign_ops = {}
+        self.prune_rates = {}
+        self.prune_ops = {}
 
         if (weights_path == 'DEFAULT'):
-            self.WEIGHTS_PATH = 'bvlc_alexnet.npy'
+            self.WEIGHTS_PATH = default_weights_path()
         else:
             self.WEIGHTS_PATH = weights_path
         # call the create function
@@ -18,23 +36,27 @@ class AlexNet(object):
 
     def create(self):
         # 1st Layer: Conv (w ReLu) -> Pool -> Lrn
-        conv1 = conv(self.X, 11, 11, 96, 4, 4, padding = 'VALID', name = 'conv1')
+        conv1 = conv(self.X, 11, 11, 96, 4, 4, padding = 'VALID', name = 'conv1',
+                     fused = self.FUSED)
         pool1 = max_pool(conv1, 3, 3, 2, 2, padding = 'VALID', name = 'pool1')
         norm1 = lrn(pool1, 2, 2e-05, 0.75, name = 'norm1')
 
         # 2nd Layer: Conv (w ReLu) -> Pool -> Lrn with 2 groups
-        conv2 = conv(norm1, 5, 5, 256, 1, 1, groups = 2, name = 'conv2')
+        conv2 = conv(norm1, 5, 5, 256, 1, 1, groups = 2, name = 'conv2',
+                     group_conv = self.GROUP_CONV, fused = self.FUSED)
         pool2 = max_pool(conv2, 3, 3, 2, 2, padding = 'VALID', name ='pool2')
         norm2 = lrn(pool2, 2, 2e-05, 0.75, name = 'norm2')
 
         # 3rd Layer: Conv (w ReLu)
-        conv3 = conv(norm2, 3, 3, 384, 1, 1, name = 'conv3')
+        conv3 = conv(norm2, 3, 3, 384, 1, 1, name = 'conv3', fused = self.FUSED)
 
         # 4th Layer: Conv (w ReLu) splitted into two groups
-        conv4 = conv(conv3, 3, 3, 384, 1, 1, groups = 2, name = 'conv4')
+        conv4 = conv(conv3, 3, 3, 384, 1, 1, groups = 2, name = 'conv4',
+                     group_conv = self.GROUP_CONV, fused = self.FUSED)
 
         # 5th Layer: Conv (w ReLu) -> Pool splitted into two groups
-        conv5 = conv(conv4, 3, 3, 256, 1, 1, groups = 2, name = 'conv5')
+        conv5 = conv(conv4, 3, 3, 256, 1, 1, groups = 2, name = 'conv5',
+                     group_conv = self.GROUP_CONV, fused = self.FUSED)
         pool5 = max_pool(conv5, 3, 3, 2, 2, padding = 'VALID', name = 'pool5')
 
         # 6th Layer: Flatten -> FC (w ReLu) -> Dropout
@@ -54,39 +76,144 @@ class AlexNet(object):
       As the weights from http://www.cs.toronto.edu/~guerzhoy/tf_alexnet/ come
       as a dict of lists (e.g. weights['conv1'] is a list) and not as dict of
       dicts (e.g. weights['conv1'] is a dict with keys 'weights' & 'biases') we
-      need a special load function
+      need a special load function. All tensors are fed through placeholder
+      assign ops that are built once, in a single session run. float16 and
+      bfloat16 weight containers are upcast tensor by tensor while loading
       """
-      # Load the weights into memory
-      weights_dict = np.load(self.WEIGHTS_PATH, encoding = 'bytes').item()
+      # Load the weights, memory-mapped when stored as plain arrays
+      weights_dict = load_weights_dict(self.WEIGHTS_PATH)
 
       # Loop over all layer names stored in the weights dict
       # store the layer names
       self.layer_names = []
+      assign_ops = []
+      feed_dict = {}
       for op_name in weights_dict:
           self.layer_names.append(op_name)
-          with tf.variable_scope(op_name, reuse = True):
-            # Loop over list of weights/biases and assign them to their corresponding tf variable
-            for data in weights_dict[op_name]:
-              # Biases
-              if len(data.shape) == 1:
-                var = tf.get_variable('biases', trainable = True)
-                session.run(var.assign(data))
-              # Weights
-              else:
-                var = tf.get_variable('weights', trainable = True)
-                session.run(var.assign(data))
+          # Loop over list of weights/biases and assign them to their corresponding tf variable
+          for data in weights_dict[op_name]:
+            # Biases
+            if len(data.shape) == 1:
+              assign_op, value = self.weight_assign_op(op_name, 'biases')
+            # Weights
+            else:
+              assign_op, value = self.weight_assign_op(op_name, 'weights')
+            assign_ops.append(assign_op)
+            feed_dict[value] = data
+      session.run(assign_ops, feed_dict = feed_dict)
+
+    def weight_assign_op(self, op_name, var_name):
+      """
+      Return the (cached) assign op and its placeholder for a layer variable,
+      so that reloading weights does not grow the graph
+      """
+      key = (op_name, var_name)
+      if key not in self.weight_assign_ops:
+        # the masks are bool, get_variable would ask for float32
+        dtype = tf.bool if var_name == 'weights_mask' else tf.float32
+        with tf.variable_scope(op_name, reuse = True):
+          var = tf.get_variable(var_name, dtype = dtype)
+        value = tf.placeholder(var.dtype.base_dtype, var.get_shape())
+        self.weight_assign_ops[key] = (var.assign(value), value)
+      return self.weight_assign_ops[key]
+
+    def weight_variables(self):
+      """
+      {layer: weights variable} of all eight layers
+      """
+      variables = {}
+      for op_name in LAYER_NAMES:
+        with tf.variable_scope(op_name, reuse = True):
+          variables[op_name] = tf.get_variable('weights')
+      return variables
+
+    def bias_variables(self):
+      """
+      {layer: biases variable} of all eight layers
+      """
+      variables = {}
+      for op_name in LAYER_NAMES:
+        with tf.variable_scope(op_name, reuse = True):
+          variables[op_name] = tf.get_variable('biases')
+      return variables
+
     def mask_weights(self, weights_mask, session):
-      for op_name in self.layer_names:
+      """
+      Load {layer: mask} into the weights_mask variables. The masks can be
+      PackedMask, bool or legacy int arrays and are fed as bool, in one run
+      """
+      assign_ops = []
+      feed_dict = {}
+      for op_name in LAYER_NAMES:
+        if op_name not in weights_mask:
+          continue
+        assign_op, value = self.weight_assign_op(op_name, 'weights_mask')
+        assign_ops.append(assign_op)
+        feed_dict[value] = as_bool(weights_mask[op_name])
+      session.run(assign_ops, feed_dict = feed_dict)
+
+    def mask_variables(self):
+      """
+      {layer: weights_mask variable} of all eight layers
+      """
+      variables = {}
+      for op_name in LAYER_NAMES:
         with tf.variable_scope(op_name, reuse = True):
-          var = tf.get_variable('weights_mask', trainable = False)
-          session.run(var.assign(weights_mask[op_name]))
+          variables[op_name] = tf.get_variable('weights_mask', dtype = tf.bool)
+      return variables
+
+    def prune_op(self, layer_names):
+      """
+      A single op that updates the masks of the given layers inside the
+      session, with the dynamic network surgery rule: weights below
+      0.9 * (mean + rate * std) are cut, weights above 1.1 * (mean + rate * std)
+      are spliced back. The rate of each layer is fed through
+      self.prune_rates[layer]. Ops are cached per set of layers
+      """
+      key = tuple(sorted(layer_names))
+      if key not in self.prune_ops:
+        updates = []
+        masks = self.mask_variables()
+        weights = self.weight_variables()
+        for op_name in key:
+          if op_name not in self.prune_rates:
+            self.prune_rates[op_name] = tf.placeholder(tf.float32, (), name = op_name + '_prune_rate')
+          mean, variance = tf.nn.moments(tf.reshape(weights[op_name], [-1]), axes = [0])
+          threshold = mean + self.prune_rates[op_name] * tf.sqrt(variance)
+          magnitude = tf.abs(weights[op_name])
+          keep = tf.logical_or(tf.logical_and(masks[op_name], magnitude >= 0.9 * threshold),
+                               magnitude > 1.1 * threshold)
+          updates.append(masks[op_name].assign(keep))
+        self.prune_ops[key] = tf.group(*updates)
+      return self.prune_ops[key]
 
 
 """
 global layer definitions
 """
+def masked_weights(weights):
+  """
+  Create the non-trainable bool 'weights_mask' variable next to weights and
+  return weights * mask. The gradient of the product w.r.t. weights is
+  already the masked gradient, so pruned weights get no updates from the loss
+  """
+  weights_mask = tf.get_variable('weights_mask', shape = weights.get_shape(), dtype = tf.bool,
+                                 initializer = tf.ones_initializer(), trainable = False)
+  return tf.multiply(weights, tf.cast(weights_mask, weights.dtype.base_dtype), name = 'masked_weights')
+
+def block_diagonal(weights, groups):
+  """
+  Expand a grouped [h, w, in/groups, out] kernel to the [h, w, in, out]
+  kernel of one ungrouped conv: group g reads only its own input channels
+  (zero elsewhere), so the result equals the split/concat convolution
+  """
+  in_group = int(weights.get_shape()[2])
+  blocks = tf.split(weights, groups, axis = 3)
+  return tf.concat([tf.pad(block, [[0, 0], [0, 0], [g * in_group, (groups - 1 - g) * in_group], [0, 0]])
+                    for g, block in enumerate(blocks)], axis = 3)
+
 def conv(x, filter_height, filter_width, num_filters, stride_y, stride_x, name,
-         padding='SAME', groups=1):
+         padding='SAME', groups=1, group_conv='split', fused=False):
   """
   Adapted from: https://github.com/ethereon/caffe-tensorflow
   """
@@ -100,13 +227,21 @@ def conv(x, filter_height, filter_width, num_filters, stride_y, stride_x, name,
 
   with tf.variable_scope(name) as scope:
     # Create tf variables for the weights and biases of the conv layer
-    weights = tf.get_variable('weights', shape = [filter_height, filter_width, input_channels/groups, num_filters])
+    weights = tf.get_variable('weights', shape = [filter_height, filter_width, input_channels//groups, num_filters])
     biases = tf.get_variable('biases', shape = [num_filters])
 
+    # Only the kept weights take part in the forward pass
+    weights = masked_weights(weights)
+
 
     if groups == 1:
       conv = convolve(x, weights)
 
+    # A single conv, the activations are neither split nor concatenated
+    # (at the price of the multiply-adds with the zero blocks)
+    elif group_conv == 'block_diagonal':
+      conv = convolve(x, block_diagonal(weights, groups))
+
     # In the cases of multiple groups, split inputs & weights and
     else:
       # Split input and weights and convolve them separately
@@ -117,8 +252,13 @@ def conv(x, filter_height, filter_width, num_filters, stride_y, stride_x, name,
       # Concat the convolved output together again
       conv = tf.concat(values = output_groups, axis = 3)
 
+    # The static shape is already known, BiasAdd -> Relu directly after the
+    # conv is the pattern the graph optimizer fuses into one kernel
+    if fused:
+      return tf.nn.relu(tf.nn.bias_add(conv, biases), name = scope.name)
+
     # Add biases
-    bias = tf.reshape(tf.nn.bias_add(conv, biases), conv.get_shape().as_list())
+    bias = tf.reshape(tf.nn.bias_add(conv, biases), [-1] + conv.get_shape().as_list()[1:])
 
     # Apply relu function
     relu = tf.nn.relu(bias, name = scope.name)
@@ -132,6 +272,9 @@ def fc(x, num_in, num_out, name, relu = True):
     weights = tf.get_variable('weights', shape=[num_in, num_out], trainable=True)
     biases = tf.get_variable('biases', [num_out], trainable=True)
 
+    # Only the kept weights take part in the forward pass
+    weights = masked_weights(weights)
+
     # Matrix multiply weights and inputs and add bias
     act = tf.nn.xw_plus_b(x, weights, biases, name=scope.name)
 
@@ -0,0 +1,319 @@
+################################################################################
+#Reusable inference engine for the AlexNet of myalexnet_forward_newtf.py
+#
+#The graph is built and the weights are loaded once, predict/predict_top_k
+#then only run the existing session, so a long-lived process can classify any
+#number of batches without rebuilding anything.
+################################################################################
+
+import collections
+
+import numpy as np
+import tensorflow as tf
+
+from alexnet import block_diagonal
+from caffe_classes import class_name_array, short_name_array
+from input_pipeline import preprocess_batch
+from weight_store import (LAYER_NAMES, default_weights_path, is_quantized, load_quantized,
+                          load_weights_dict)
+
+# int8 weights of a quantized layer with their per-channel scales and the
+# calibrated scale of the layer input
+QuantizedTensor = collections.namedtuple('QuantizedTensor', ['values', 'scales', 'input_scale'])
+
+def weight_density(data):
+    """
+    Fraction of non-zero entries of a weight array
+    """
+    return np.count_nonzero(data) / float(data.size)
+
+def create_variables(net_data, sparse_threshold = None, input_scales = None, fc_dtype = None):
+    """
+    Create a (weights, biases) variable pair per layer. The variables start
+    from placeholders, so the weights are fed once at initialization instead
+    of being copied into the graph definition as constants. FC weights whose
+    density is below sparse_threshold (pruned layers) are stored as a
+    tf.SparseTensor of their non-zero entries instead. With input_scales,
+    net_data is the result of weight_store.load_quantized and every layer
+    becomes a QuantizedTensor. With fc_dtype (tf.float16 or tf.bfloat16) the
+    dense fc weights are held in that precision, which lowers the idle
+    memory only: fc upcasts them on every run. Returns the variables, the
+    feed dict for their initializer and the {layer: (mode, density)} choices
+    made
+    """
+    variables = {}
+    init_feed = {}
+    layer_modes = {}
+    for name in LAYER_NAMES:
+        weights, biases = net_data[name]
+        if input_scales is not None:
+            values, scales = weights
+            values_value = tf.placeholder(tf.int8, values.shape)
+            W = QuantizedTensor(tf.Variable(values_value, name = name + 'W_int8'),
+                                tf.constant(scales), input_scales[name])
+            init_feed[values_value] = values
+            layer_modes[name] = ('int8', weight_density(values))
+        elif (sparse_threshold is not None and name.startswith('fc') and
+              weight_density(weights) < sparse_threshold):
+            # row-major (in, out) indices, the canonical SparseTensor order
+            indices = np.argwhere(weights != 0).astype(np.int64)
+            values = np.asarray(weights)[weights != 0].astype(np.float32)
+            indices_value = tf.placeholder(tf.int64, indices.shape)
+            values_value = tf.placeholder(tf.float32, values.shape)
+            W = tf.SparseTensor(tf.Variable(indices_value, name = name + 'W_indices'),
+                                tf.Variable(values_value, name = name + 'W_values'),
+                                weights.shape)
+            init_feed[indices_value] = indices
+            init_feed[values_value] = values
+            layer_modes[name] = ('sparse', weight_density(weights))
+        elif fc_dtype is not None and name.startswith('fc'):
+            # fed in the stored precision, float16 files are not upcast
+            weights_value = tf.placeholder(tf.as_dtype(weights.dtype), weights.shape)
+            W = tf.Variable(tf.cast(weights_value, fc_dtype), name = name + 'W')
+            init_feed[weights_value] = weights
+            layer_modes[name] = (fc_dtype.name, weight_density(weights))
+        else:
+            weights_value = tf.placeholder(tf.float32, weights.shape)
+            W = tf.Variable(weights_value, name = name + 'W')
+            init_feed[weights_value] = weights
+            layer_modes[name] = ('dense', weight_density(weights))
+        biases_value = tf.placeholder(tf.float32, biases.shape)
+        b = tf.Variable(biases_value, name = name + 'b')
+        init_feed[biases_value] = biases
+        variables[name] = (W, b)
+    return variables, init_feed, layer_modes
+
+def quantize_input(x, scale):
+    """
+    Round x to the int8 grid of a calibrated scale. The integer values are
+    kept in float32, the only type the CPU matmul/conv kernels take
+    """
+    return tf.clip_by_value(tf.round(x / scale), -127., 127.)
+
+def fc(x, weights, biases, relu = True):
+    """
+    x * weights + biases with an optional ReLU, where weights is either a
+    dense variable, a SparseTensor of a pruned layer or a QuantizedTensor.
+    Reduced precision dense weights are upcast for the float32 matmul, on
+    every run, the CPU kernels have no float16/bfloat16 matmul
+    """
+    if isinstance(weights, QuantizedTensor):
+        # integer products, rescaled per output channel before the bias
+        act = tf.matmul(quantize_input(x, weights.input_scale), tf.cast(weights.values, tf.float32))
+        act = tf.nn.bias_add(act * (weights.input_scale * weights.scales), biases)
+        return tf.nn.relu(act) if relu else act
+    if isinstance(weights, tf.SparseTensor):
+        # (W^T x^T)^T, the sparse operand has to come first
+        act = tf.nn.bias_add(tf.transpose(tf.sparse_tensor_dense_matmul(
+            weights, x, adjoint_a = True, adjoint_b = True)), biases)
+        return tf.nn.relu(act) if relu else act
+    if weights.dtype.base_dtype != x.dtype.base_dtype:
+        weights = tf.cast(weights, x.dtype.base_dtype)
+    if relu:
+        return tf.nn.relu_layer(x, weights, biases)
+    return tf.nn.xw_plus_b(x, weights, biases)
+
+def conv(input, kernel, biases, k_h, k_w, c_o, s_h, s_w,  padding="VALID", group=1,
+         group_conv='split', fused=False):
+    '''From https://github.com/ethereon/caffe-tensorflow
+    '''
+    scale = None
+    if isinstance(kernel, QuantizedTensor):
+        scale = kernel.input_scale * kernel.scales
+        input = quantize_input(input, kernel.input_scale)
+        kernel = tf.cast(kernel.values, tf.float32)
+    c_i = input.get_shape()[-1]
+    assert c_i%group==0
+    assert c_o%group==0
+    convolve = lambda i, k: tf.nn.conv2d(i, k, [1, s_h, s_w, 1], padding=padding)
+
+
+    if group==1:
+        conv = convolve(input, kernel)
+    elif group_conv == 'block_diagonal':
+        # one conv, no split/concat copies of the activations
+        conv = convolve(input, block_diagonal(kernel, group))
+    else:
+        input_groups =  tf.split(input, group, 3)
+        kernel_groups = tf.split(kernel, group, 3)
+        output_groups = [convolve(i, k) for i,k in zip(input_groups, kernel_groups)]
+        conv = tf.concat(output_groups, 3)
+    if scale is not None:
+        conv = conv * scale
+    if fused:
+        # no reshape between BiasAdd and the caller's Relu, so that the graph
+        # optimizer can fuse Conv2D + BiasAdd + Relu
+        return tf.nn.bias_add(conv, biases)
+    return  tf.reshape(tf.nn.bias_add(conv, biases), [-1]+conv.get_shape().as_list()[1:])
+
+def forward(x, variables, endpoints = None, group_conv = 'split', fused = False):
+    """
+    Build the forward pass of myalexnet_forward_newtf.py on x and return the
+    fc8 logits. If given, endpoints is filled with the input tensor of every
+    layer (used for calibration). group_conv is one of
+    alexnet.GROUP_CONV_MODES, fused drops the reshapes after the conv biases
+    """
+    radius = 2; alpha = 2e-05; beta = 0.75; bias = 1.0
+
+    #conv1
+    conv1W, conv1b = variables["conv1"]
+    conv1 = tf.nn.relu(conv(x, conv1W, conv1b, 11, 11, 96, 4, 4, padding="SAME", group=1,
+                            fused=fused))
+
+    #lrn1
+    lrn1 = tf.nn.local_response_normalization(conv1, depth_radius=radius, alpha=alpha,
+                                              beta=beta, bias=bias)
+
+    #maxpool1
+    maxpool1 = tf.nn.max_pool(lrn1, ksize=[1, 3, 3, 1], strides=[1, 2, 2, 1], padding='VALID')
+
+    #conv2
+    conv2W, conv2b = variables["conv2"]
+    conv2 = tf.nn.relu(conv(maxpool1, conv2W, conv2b, 5, 5, 256, 1, 1, padding="SAME", group=2,
+                            group_conv=group_conv, fused=fused))
+
+    #lrn2
+    lrn2 = tf.nn.local_response_normalization(conv2, depth_radius=radius, alpha=alpha,
+                                              beta=beta, bias=bias)
+
+    #maxpool2
+    maxpool2 = tf.nn.max_pool(lrn2, ksize=[1, 3, 3, 1], strides=[1, 2, 2, 1], padding='VALID')
+
+    #conv3
+    conv3W, conv3b = variables["conv3"]
+    conv3 = tf.nn.relu(conv(maxpool2, conv3W, conv3b, 3, 3, 384, 1, 1, padding="SAME", group=1,
+                            fused=fused))
+
+    #conv4
+    conv4W, conv4b = variables["conv4"]
+    conv4 = tf.nn.relu(conv(conv3, conv4W, conv4b, 3, 3, 384, 1, 1, padding="SAME", group=2,
+                            group_conv=group_conv, fused=fused))
+
+    #conv5
+    conv5W, conv5b = variables["conv5"]
+    conv5 = tf.nn.relu(conv(conv4, conv5W, conv5b, 3, 3, 256, 1, 1, padding="SAME", group=2,
+                            group_conv=group_conv, fused=fused))
+
+    #maxpool5
+    maxpool5 = tf.nn.max_pool(conv5, ksize=[1, 3, 3, 1], strides=[1, 2, 2, 1], padding='VALID')
+
+    #fc6
+    fc6W, fc6b = variables["fc6"]
+    flattened = tf.reshape(maxpool5, [-1, int(np.prod(maxpool5.get_shape()[1:]))])
+    fc6 = fc(flattened, fc6W, fc6b)
+
+    #fc7
+    fc7W, fc7b = variables["fc7"]
+    fc7 = fc(fc6, fc7W, fc7b)
+
+    if endpoints is not None:
+        endpoints.update(zip(LAYER_NAMES, [x, maxpool1, maxpool2, conv3, conv4,
+                                           flattened, fc6, fc7]))
+
+    #fc8
+    fc8W, fc8b = variables["fc8"]
+    return fc(fc7, fc8W, fc8b, relu = False)
+
+
+class AlexNetPredictor(object):
+    """
+    Owns a graph, a session and the loaded weights. Inputs are either BGR
+    float batches of shape (N, 227, 227, 3) or lists of encoded JPEG/PNG
+    images, which are preprocessed inside the graph
+    """
+    def __init__(self, weights_path = None, num_threads = 0, warmup_batch_size = 1,
+                 sparse_threshold = None, fc_dtype = None, group_conv = 'split',
+                 fused = False):
+        # -num_threads: intra/inter op threads, 0 lets TensorFlow pick
+        # -sparse_threshold: run pruned fc layers below this density as
+        #  sparse-dense matmuls (see layer_modes for what was picked)
+        # -weights_path may also be an int8 file of quantize_alexnet.py, all
+        #  conv/fc layers then run quantized
+        # -fc_dtype: 'float16' or 'bfloat16' keeps the fc weights in that
+        #  precision in the graph. Lower idle memory, but higher peak
+        #  memory and latency: every run materializes a float32 copy of the
+        #  fc weights next to them. Without it a reduced precision file is
+        #  upcast once on load
+        # -group_conv: one of alexnet.GROUP_CONV_MODES for conv2/4/5
+        # -fused: graph optimized conv layers, see forward
+        if weights_path is None:
+            weights_path = default_weights_path()
+        self.WEIGHTS_PATH = weights_path
+
+        self.graph = tf.Graph()
+        with self.graph.as_default():
+            # either feed prepared float images to x, or encoded JPEG/PNG
+            # bytes to encoded and let the graph do the preprocessing
+            self.encoded = tf.placeholder(tf.string, (None,))
+            self.x = tf.placeholder_with_default(preprocess_batch(self.encoded),
+                                                 (None, 227, 227, 3))
+            if weights_path.endswith('.npz') and is_quantized(weights_path):
+                # int8 weights written by quantize_alexnet.py
+                net_data, input_scales = load_quantized(weights_path)
+            else:
+                net_data = load_weights_dict(weights_path, upcast = fc_dtype is None)
+                input_scales = None
+            variables, init_feed, self.layer_modes = create_variables(
+                net_data, sparse_threshold, input_scales,
+                tf.as_dtype(fc_dtype) if fc_dtype is not None else None)
+            self.logits = forward(self.x, variables, group_conv = group_conv, fused = fused)
+            self.prob = tf.nn.softmax(self.logits)
+
+            # only the k winners leave the session
+            self.k = tf.placeholder_with_default(5, ())
+            self.top_k_probs, self.top_k_inds = tf.nn.top_k(self.prob, self.k)
+
+            config = tf.ConfigProto(intra_op_parallelism_threads = num_threads,
+                                    inter_op_parallelism_threads = num_threads)
+            self.sess = tf.Session(graph = self.graph, config = config)
+            self.sess.run(tf.global_variables_initializer(), feed_dict = init_feed)
+
+        # nothing may be added to the graph from here on
+        self.graph.finalize()
+
+        # the first run pays for kernel selection and memory allocation
+        if warmup_batch_size:
+            self.predict(np.zeros((warmup_batch_size, 227, 227, 3), dtype = np.float32))
+
+    def predict(self, batch):
+        """
+        Class probabilities, shape (N, 1000)
+        """
+        return self.sess.run(self.prob, feed_dict = {self.x: batch})
+
+    def predict_top_k(self, batch, k = 5):
+        """
+        The k most likely classes of every image, as (indices, probs) arrays
+        of shape (N, k) sorted by decreasing probability
+        """
+        return self.sess.run([self.top_k_inds, self.top_k_probs],
+                             feed_dict = {self.x: batch, self.k: k})
+
+    def predict_encoded(self, images):
+        """
+        Class probabilities for a list of encoded image byte strings
+        """
+        return self.sess.run(self.prob, feed_dict = {self.encoded: images})
+
+    def predict_logits_encoded(self, images):
+        """
+        fc8 logits for a list of encoded image byte strings
+        """
+        return self.sess.run(self.logits, feed_dict = {self.encoded: images})
+
+    def predict_top_k_encoded(self, images, k = 5):
+        """
+        predict_top_k for a list of encoded image byte strings
+        """
+        return self.sess.run([self.top_k_inds, self.top_k_probs],
+                             feed_dict = {self.encoded: images, self.k: k})
+
+    def label_names(self, inds, short = False):
+        """
+        Map an array of class indices to their (short) names
+        """
+        names = short_name_array if short else class_name_array
+        return names[np.asarray(inds)].tolist()
+
+    def close(self):
+        self.sess.close()
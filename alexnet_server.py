@@ -0,0 +1,327 @@
+################################################################################
+#Dynamic micro-batching inference server for AlexNetPredictor
+#
+#Concurrent requests are queued and collected into one batch until either
+#max_batch_size images are waiting or the oldest one has waited max_latency
+#seconds. Each batch costs a single sess.run, the top-k results are fanned
+#back out to the callers. The front end is a minimal HTTP/1.1 server on a
+#local TCP port or a Unix socket:
+#
+#  POST /predict   body: one (227, 227, 3) BGR float image as .npy bytes, or
+#                  with Content-Type image/jpeg or image/png the encoded image,
+#                  which is preprocessed inside the graph (about 10x smaller)
+#  GET  /metrics   latency percentiles and batch fill as JSON
+#
+#Bad request bodies get a 400, bodies over max_body_size a 413 and failures
+#of the predictor a 500, always with a JSON {"error": ...} payload.
+################################################################################
+
+import argparse
+import asyncio
+import collections
+import io
+import json
+import time
+
+import numpy as np
+
+class MicroBatcher(object):
+    """
+    Collects single images into batches for predictor.predict_top_k, or for
+    predictor.predict_top_k_encoded when the images are encoded bytes. Any
+    object with that method works, which keeps the batching testable
+    without TensorFlow
+    """
+    def __init__(self, predictor, max_batch_size = 32, max_latency = 0.005, k = 5,
+                 history = 10000, encoded = False):
+        self.predictor = predictor
+        self.encoded = encoded
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency
+        self.k = k
+
+        # rolling windows for the metrics
+        self.latencies = collections.deque(maxlen = history)
+        self.batch_sizes = collections.deque(maxlen = history)
+        self.num_requests = 0
+        self.num_batches = 0
+
+        self._queue = None
+        self._worker = None
+
+    def start(self):
+        """
+        Start the batching task on the running event loop
+        """
+        self._queue = asyncio.Queue()
+        self._worker = asyncio.ensure_future(self._run())
+
+    async def stop(self):
+        self._worker.cancel()
+        try:
+            await self._worker
+        except asyncio.CancelledError:
+            pass
+
+    async def submit(self, image):
+        """
+        Queue one image and wait for its (indices, probs) top-k result
+        """
+        future = asyncio.get_event_loop().create_future()
+        await self._queue.put((image, future, time.monotonic()))
+        return await future
+
+    async def _run(self):
+        while True:
+            # block for the first request, then fill up until the deadline
+            pending = [await self._queue.get()]
+            deadline = pending[0][2] + self.max_latency
+            while len(pending) < self.max_batch_size:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    pending.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+            while len(pending) < self.max_batch_size and not self._queue.empty():
+                pending.append(self._queue.get_nowait())
+
+            results = await self._predict([image for image, _, _ in pending])
+
+            done = time.monotonic()
+            self.num_batches += 1
+            self.batch_sizes.append(len(pending))
+            for (_, future, start), result in zip(pending, results):
+                self.num_requests += 1
+                self.latencies.append(done - start)
+                if future.done():
+                    continue
+                if isinstance(result, Exception):
+                    future.set_exception(result)
+                else:
+                    future.set_result(result)
+
+    async def _predict(self, images):
+        """
+        (indices, probs) or the exception for every image. When the batch
+        fails, the images are retried one by one, so that one bad request
+        (e.g. a corrupt JPEG) does not fail the others of its batch
+        """
+        loop = asyncio.get_event_loop()
+        if self.encoded:
+            predict_top_k = self.predictor.predict_top_k_encoded
+            as_batch = list
+        else:
+            predict_top_k = self.predictor.predict_top_k
+            as_batch = np.stack
+        try:
+            # keep the event loop serving connections during sess.run
+            inds, probs = await loop.run_in_executor(None, predict_top_k, as_batch(images), self.k)
+            return list(zip(inds, probs))
+        except Exception as e:
+            if len(images) == 1:
+                return [e]
+        results = []
+        for image in images:
+            results.extend(await self._predict([image]))
+        return results
+
+    def metrics(self):
+        """
+        p50/p99 latency in milliseconds and how full the batches are
+        """
+        latencies = np.array(self.latencies) * 1000.
+        batch_sizes = np.array(self.batch_sizes, dtype = np.float64)
+        return {
+            'requests': self.num_requests,
+            'batches': self.num_batches,
+            'latency_p50_ms': float(np.percentile(latencies, 50)) if len(latencies) else None,
+            'latency_p99_ms': float(np.percentile(latencies, 99)) if len(latencies) else None,
+            'mean_batch_size': float(batch_sizes.mean()) if len(batch_sizes) else None,
+            'batch_fill': float(batch_sizes.mean() / self.max_batch_size) if len(batch_sizes) else None,
+        }
+
+
+class InferenceServer(object):
+    """
+    HTTP/1.1 front end for a MicroBatcher, with keep-alive connections
+    """
+    def __init__(self, batcher, label_names = None, encoded_batcher = None,
+                 max_body_size = 16 * 2**20):
+        # -label_names: optional callable mapping an index array to class names
+        # -encoded_batcher: MicroBatcher for encoded JPEG/PNG request bodies
+        # -max_body_size: larger request bodies are refused with 413
+        self.batcher = batcher
+        self.encoded_batcher = encoded_batcher
+        self.label_names = label_names
+        self.max_body_size = max_body_size
+        self.server = None
+
+    async def start(self, host = '127.0.0.1', port = 8000, unix_path = None):
+        self.batcher.start()
+        if self.encoded_batcher is not None:
+            self.encoded_batcher.start()
+        if unix_path is not None:
+            self.server = await asyncio.start_unix_server(self._handle, path = unix_path)
+        else:
+            self.server = await asyncio.start_server(self._handle, host, port)
+        return self.server
+
+    async def stop(self):
+        self.server.close()
+        await self.server.wait_closed()
+        await self.batcher.stop()
+        if self.encoded_batcher is not None:
+            await self.encoded_batcher.stop()
+
+    async def _handle(self, reader, writer):
+        try:
+            while True:
+                request_line = await reader.readline()
+                if not request_line:
+                    break
+                try:
+                    method, path, headers = await self._read_head(request_line, reader)
+                    length = int(headers.get('content-length', 0))
+                    if length < 0:
+                        raise ValueError('negative Content-Length')
+                except ValueError as e:
+                    # the framing is lost, answer and drop the connection
+                    await self._write(writer, '400 Bad Request', {'error': str(e)}, True)
+                    break
+
+                close = headers.get('connection', '').lower() == 'close'
+                if length > self.max_body_size:
+                    # the body is not read, so the connection cannot be reused
+                    status, payload, close = '413 Payload Too Large', {
+                        'error': 'body of {} bytes exceeds {}'.format(length, self.max_body_size)}, True
+                else:
+                    body = await reader.readexactly(length)
+                    status, payload = await self._respond(method, path, body,
+                                                          headers.get('content-type', ''))
+                await self._write(writer, status, payload, close)
+                if close:
+                    break
+        except (asyncio.IncompleteReadError, ConnectionResetError):
+            pass
+        finally:
+            writer.close()
+
+    async def _read_head(self, request_line, reader):
+        """
+        Method, path and lower-cased headers of a request, ValueError if they
+        are malformed
+        """
+        method, path, _ = request_line.decode('latin1').split(' ', 2)
+        headers = {}
+        while True:
+            line = await reader.readline()
+            if line in (b'\r\n', b'\n', b''):
+                break
+            name, value = line.decode('latin1').split(':', 1)
+            headers[name.strip().lower()] = value.strip()
+        return method, path, headers
+
+    async def _write(self, writer, status, payload, close = False):
+        data = json.dumps(payload).encode('utf-8')
+        writer.write('HTTP/1.1 {}\r\nContent-Type: application/json\r\n'
+                     'Content-Length: {}\r\n{}\r\n'.format(
+                         status, len(data), 'Connection: close\r\n' if close else '').encode('latin1'))
+        writer.write(data)
+        await writer.drain()
+
+    async def _respond(self, method, path, body, content_type):
+        """
+        _dispatch, with any failure turned into a 500 response
+        """
+        try:
+            return await self._dispatch(method, path, body, content_type)
+        except Exception as e:
+            return '500 Internal Server Error', {'error': '{}: {}'.format(type(e).__name__, e)}
+
+    async def _dispatch(self, method, path, body, content_type):
+        if method == 'GET' and path == '/metrics':
+            metrics = self.batcher.metrics()
+            if self.encoded_batcher is not None:
+                metrics['encoded'] = self.encoded_batcher.metrics()
+            return '200 OK', metrics
+        if method == 'POST' and path == '/predict':
+            if content_type.startswith('image/'):
+                if self.encoded_batcher is None:
+                    return '415 Unsupported Media Type', {'error': 'encoded images are not enabled'}
+                inds, probs = await self.encoded_batcher.submit(body)
+            else:
+                try:
+                    image = self.decode_image(body)
+                except ValueError as e:
+                    return '400 Bad Request', {'error': str(e)}
+                inds, probs = await self.batcher.submit(image)
+            payload = {'classes': inds.tolist(), 'probs': probs.tolist()}
+            if self.label_names is not None:
+                payload['names'] = self.label_names(inds)
+            return '200 OK', payload
+        return '404 Not Found', {'error': 'unknown endpoint {} {}'.format(method, path)}
+
+    def decode_image(self, body):
+        """
+        Parse a request body into a single (227, 227, 3) float32 image
+        """
+        try:
+            image = np.load(io.BytesIO(body), allow_pickle = False)
+        except Exception as e:
+            raise ValueError('body is not a .npy array: {}'.format(e))
+        if not isinstance(image, np.ndarray) or image.shape != (227, 227, 3):
+            raise ValueError('expected a (227, 227, 3) image, got {}'.format(image.shape))
+        return image.astype(np.float32, copy = False)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'AlexNet micro-batching server')
+    parser.add_argument('--host', default = '127.0.0.1')
+    parser.add_argument('--port', type = int, default = 8000)
+    parser.add_argument('--unix', default = None, help = 'listen on a Unix socket instead')
+    parser.add_argument('--weights', default = None)
+    parser.add_argument('--max_batch_size', type = int, default = 32)
+    parser.add_argument('--max_latency_ms', type = float, default = 5.)
+    parser.add_argument('--top_k', type = int, default = 5)
+    parser.add_argument('--max_body_size', type = int, default = 16 * 2**20,
+                        help = 'largest accepted request body in bytes')
+    parser.add_argument('--threads', type = int, default = 0)
+    parser.add_argument('--sparse_threshold', type = float, default = None,
+                        help = 'run pruned fc layers below this density sparse')
+    parser.add_argument('--fc_dtype', default = None, choices = ['float16', 'bfloat16'],
+                        help = 'keep the fc weights in reduced precision: lower idle '
+                               'memory, higher peak memory and latency')
+    parser.add_argument('--group_conv', default = 'split', choices = ['split', 'block_diagonal'],
+                        help = 'implementation of the grouped convs')
+    parser.add_argument('--fused', action = 'store_true',
+                        help = 'graph optimized conv layers without the bias reshapes')
+    args = parser.parse_args()
+
+    from alexnet_predictor import AlexNetPredictor
+    predictor = AlexNetPredictor(args.weights, num_threads = args.threads,
+                                 warmup_batch_size = args.max_batch_size,
+                                 sparse_threshold = args.sparse_threshold,
+                                 fc_dtype = args.fc_dtype, group_conv = args.group_conv,
+                                 fused = args.fused)
+    print('layer modes: {}'.format(predictor.layer_modes))
+    batcher = MicroBatcher(predictor, args.max_batch_size, args.max_latency_ms / 1000.,
+                           args.top_k)
+    encoded_batcher = MicroBatcher(predictor, args.max_batch_size, args.max_latency_ms / 1000.,
+                                   args.top_k, encoded = True)
+    server = InferenceServer(batcher, predictor.label_names, encoded_batcher,
+                             max_body_size = args.max_body_size)
+
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(server.start(args.host, args.port, args.unix))
+    print('serving on {}'.format(args.unix or '{}:{}'.format(args.host, args.port)))
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    loop.run_until_complete(server.stop())
+
+
+if __name__ == '__main__':
+    main()
@@ -5,11 +5,14 @@ import os
 import pickle
 import time
 import getopt
-import cv2
+from datetime import datetime
 
-from alexnet import AlexNet
+import input_pipeline
+from alexnet import AlexNet, LAYER_NAMES
 from caffe_classes import class_names
-from datagenerator import ImageDataGenerator
+from datagenerator import ImageDataGenerator, PackedDataGenerator
+from weight_store import save_pruned, write_weights
+from weight_mask import PackedMask, chunked_mean_std, pack_masks, prune_mask
 
 
 
@@ -61,43 +64,62 @@ def initialize_variables(exist, file_name):
         }
     return (weights, biases)
 
+def check_rates(cRates):
+    """
+    cRates are keyed by AlexNet layer name (alexnet.LAYER_NAMES). Any other
+    key, e.g. the cov1/fc1 names of the old CIFAR network, would silently
+    prune nothing, so it is an error
+    """
+    unknown = sorted(key for key in cRates if key not in LAYER_NAMES)
+    if unknown:
+        raise ValueError('cRates keys {} match no layer, use {}'.format(unknown, LAYER_NAMES))
+
 def prune_weights(cRates, weights, weights_mask, biases, biases_mask, mask_dir, f_name):
-    keys = ['cov1','cov2','fc1','fc2','fc3']
-    new_mask = {}
-    for key in keys:
+    # -weights: {layer: weights variable}, e.g. AlexNet.weight_variables();
+    #  the layers with a rate in cRates are pruned, their masks are updated
+    #  in place one layer at a time (weight_mask.prune_mask)
+    check_rates(cRates)
+    prune_cost = {}
+    for key in sorted(cRates):
+        start = time.time()
         w_eval = weights[key].eval()
-        threshold_off = 0.9*(np.mean(w_eval) + cRates[key] * np.std(w_eval))
-        threshold_on = 1.1*(np.mean(w_eval) + cRates[key] * np.std(w_eval))
-        mask_off = np.abs(w_eval) < threshold_off
-        mask_on = np.abs(w_eval) > threshold_on
-        new_mask[key] = np.logical_or(((1 - mask_off) * weights_mask[key]),mask_on).astype(int)
+        mean, std = chunked_mean_std(w_eval)
+        threshold_off = 0.9*(mean + cRates[key] * std)
+        threshold_on = 1.1*(mean + cRates[key] * std)
+        prune_mask(weights_mask[key], w_eval, threshold_off, threshold_on)
+        del w_eval
+        prune_cost[key] = time.time() - start
+    print('prune step took {:.3f}s: {}'.format(sum(prune_cost.values()), prune_cost))
     with open(mask_dir + f_name, 'wb') as f:
-        pickle.dump((new_mask,biases_mask), f)
+        pickle.dump((weights_mask,biases_mask), f)
+    return prune_cost
 
 def initialize_weights_mask(first_time_training, mask_dir, file_name):
+    # mask shapes follow the AlexNet variables (conv2/4/5 are grouped)
     NUM_CHANNELS = 3
-    NUM_CLASSES = 10
+    NUM_CLASSES = 1000
     if (first_time_training == 1):
         print('setting initial mask value')
+        # one bit per weight, see weight_mask.PackedMask
         weights_mask = {
-            'cov1': np.ones([11, 11, NUM_CHANNELS, 96]),
-            'cov2': np.ones([5, 5, 96, 256]),
-            'cov3': np.ones([3, 3, 256, 384]),
-            'cov4': np.ones([3, 3, 384, 384]),
-            'cov5': np.ones([3, 3, 384, 256]),
-            'fc6': np.ones([6 * 6 * 256, 4096]),
-            'fc7': np.ones([4096, 4096]),
-            'fc8': np.ones([4096, NUM_CLASSES])
+            'conv1': PackedMask.ones([11, 11, NUM_CHANNELS, 96]),
+            'conv2': PackedMask.ones([5, 5, 48, 256]),
+            'conv3': PackedMask.ones([3, 3, 256, 384]),
+            'conv4': PackedMask.ones([3, 3, 192, 384]),
+            'conv5': PackedMask.ones([3, 3, 192, 256]),
+            'fc6': PackedMask.ones([6 * 6 * 256, 4096]),
+            'fc7': PackedMask.ones([4096, 4096]),
+            'fc8': PackedMask.ones([4096, NUM_CLASSES])
         }
         biases_mask = {
-            'cov1': np.ones([64]),
-            'cov2': np.ones([64]),
-            'cov3': np.ones([64]),
-            'cov4': np.ones([64]),
-            'cov5': np.ones([64]),
-            'fc6': np.ones([384]),
-            'fc7': np.ones([192]),
-            'fc8': np.ones([NUM_CLASSES])
+            'conv1': np.ones([96], dtype = bool),
+            'conv2': np.ones([256], dtype = bool),
+            'conv3': np.ones([384], dtype = bool),
+            'conv4': np.ones([384], dtype = bool),
+            'conv5': np.ones([256], dtype = bool),
+            'fc6': np.ones([4096], dtype = bool),
+            'fc7': np.ones([4096], dtype = bool),
+            'fc8': np.ones([NUM_CLASSES], dtype = bool)
         }
 
         # with open(mask_dir + 'maskcov0cov0fc0fc0fc0.pkl', 'wb') as f:
@@ -105,6 +127,8 @@ def initialize_weights_mask(first_time_training, mask_dir, file_name):
     else:
         with open(mask_dir + file_name,'rb') as f:
             (weights_mask, biases_mask) = pickle.load(f)
+        # masks pickled as int64 arrays by older runs
+        weights_mask = pack_masks(weights_mask)
     print('weights set')
     return (weights_mask, biases_mask)
 
@@ -174,6 +198,25 @@ def save_pkl_model(weights, biases, save_dir ,f_name):
         print('Created a pickle file')
         pickle.dump((weights_val, biases_val), f)
 
+def save_checkpoint(weights, biases, save_dir, f_name):
+    # the full weights, pruned ones included so that dynamic network surgery
+    # can splice them back, as a memory-mapped container (weight_store). The
+    # file is replaced atomically, it may still be mapped by this process
+    weights_val = {}
+    for key in weights:
+        weights_val[key] = [weights[key].eval(), biases[key].eval()]
+    write_weights(weights_val, save_dir + f_name + '.tmp')
+    os.replace(save_dir + f_name + '.tmp', save_dir + f_name)
+
+def save_compressed_model(weights, biases, weights_mask, save_dir, f_name, codebook_bits = None):
+    # -weights, biases, weights_mask: {layer: variable}, e.g. from AlexNet
+    # only the surviving weights are stored (weight_store.save_pruned), the
+    # mask is implicit and does not need a separate pickle
+    weights_val = {}
+    for key in weights:
+        weights_val[key] = [weights[key].eval() * weights_mask[key].eval(), biases[key].eval()]
+    save_pruned(weights_val, save_dir + f_name, codebook_bits = codebook_bits)
+
 def calculate_non_zero_weights(weight):
     count = (weight != 0).sum()
     size = len(weight.flatten())
@@ -184,17 +227,47 @@ def ClipIfNotNone(grad):
         return grad
     return tf.clip_by_value(grad, -1, 1)
 
+def accumulate_gradients(opt, grads_and_vars, accum_steps):
+    """
+    Build the ops for gradient accumulation: one that adds the (averaged)
+    gradients of a micro batch to non-trainable accumulators, and one that
+    applies the accumulated gradients and zeroes the accumulators again
+    """
+    accum_ops = []
+    accum_grads = []
+    for grad, var in grads_and_vars:
+        if grad is None:
+            continue
+        accum = tf.Variable(tf.zeros(var.get_shape(), dtype = var.dtype.base_dtype),
+                            trainable = False)
+        accum_ops.append(accum.assign_add(grad / accum_steps))
+        accum_grads.append((accum, var))
+
+    apply_op = opt.apply_gradients(accum_grads)
+    with tf.control_dependencies([apply_op]):
+        reset_op = tf.group(*[accum.assign(tf.zeros_like(accum)) for accum, _ in accum_grads])
+    return (tf.group(*accum_ops), reset_op)
+
+def evaluate(sess, accuracy, x, y, keep_prob, generator, batch_size):
+    """
+    Mean accuracy over one pass of a generator, without dropout
+    """
+    batch_size = max(min(batch_size, generator.data_size), 1)
+    steps = max(generator.data_size // batch_size, 1)
+    generator.reset_pointer()
+    total = 0.
+    for step in range(steps):
+        (batch_x, batch_y) = generator.next_batch(batch_size)
+        total += sess.run(accuracy, feed_dict = {x: batch_x, y: batch_y, keep_prob: 1.0})
+    return total / steps
+
 def compute_file_name(thresholds):
-    keys_cov = ['cov1', 'cov2']
-    keys_fc = ['fc1', 'fc2', 'fc3']
+    # the rate of every layer in hundredths, e.g. conv1_0conv2_50...fc6_170...;
+    # layers without a rate count as 0
+    check_rates(thresholds)
     name = ''
-    for key in keys_cov:
-        name += 'cov'+ str(int(thresholds[key]*10))
-    for key in keys_fc:
-        if (key == 'fc1'):
-            name += 'fc'+ str(int(thresholds[key]*100))
-        else:
-            name += 'fc'+ str(int(thresholds[key]*10))
+    for key in LAYER_NAMES:
+        name += key + '_' + str(int(round(thresholds.get(key, 0.) * 100)))
     return name
 
 
@@ -206,11 +279,25 @@ def main(argv = None):
             opts = argv
             first_time_load = True
             parent_dir = './'
-            keys = ['cov1', 'cov2', 'fc1', 'fc2', 'fc3']
+            keys = LAYER_NAMES
             prune_thresholds = {}
             WITH_BIASES = False
             save_for_next_iter = False
             TEST = False
+            LOCAL_TEST = False
+            TRAIN = False
+            PRUNE = False
+            PREFETCH = 4
+            NUM_WORKERS = None
+            PACKED_PREFIX = None
+            SPARSE_LABELS = False
+            LAZY_CLASS_LIST = False
+            TF_DATA = False
+            batch_size = 1
+            ACCUM_STEPS = 1
+            NUM_THREADS = 0
+            GROUP_CONV = 'split'
+            FUSED = False
             for key in keys:
                 prune_thresholds[key] = 0.
 
@@ -230,6 +317,8 @@ def main(argv = None):
                     PRUNE = val
                 if (opt == '-test'):
                     TEST = val
+                if (opt == '-local_test'):
+                    LOCAL_TEST = val
                 if (opt == '-parent_dir'):
                     parent_dir = val
                 if (opt == '-lr'):
@@ -244,14 +333,35 @@ def main(argv = None):
                     save_for_next_iter = val
                 if (opt == '-org_file_name'):
                     org_file_name = val
+                if (opt == '-prefetch'):
+                    PREFETCH = val
+                if (opt == '-num_workers'):
+                    NUM_WORKERS = val
+                if (opt == '-packed_prefix'):
+                    PACKED_PREFIX = val
+                if (opt == '-sparse_labels'):
+                    SPARSE_LABELS = val
+                if (opt == '-lazy_class_list'):
+                    LAZY_CLASS_LIST = val
+                if (opt == '-tf_data'):
+                    TF_DATA = val
+                if (opt == '-batch_size'):
+                    batch_size = val
+                if (opt == '-accum_steps'):
+                    ACCUM_STEPS = val
+                if (opt == '-num_threads'):
+                    NUM_THREADS = val
+                if (opt == '-group_conv'):
+                    GROUP_CONV = val
+                if (opt == '-fused'):
+                    FUSED = val
 
 
             print('pruning thresholds are {}'.format(prune_thresholds))
-        except getopt.error, msg:
+        except getopt.error as msg:
             raise Usage(msg)
         epochs = 100
         dropout = 0.5
-        batch_size = 1
         num_classes = 1000
 
         NUM_EXAMPLES_PER_EPOCH_FOR_TRAIN = 50000
@@ -260,22 +370,29 @@ def main(argv = None):
         LEARNING_RATE_DECAY_FACTOR = 0.1
         NUM_EPOCHS_PER_DECAY = 350.0
         DISPLAY_FREQ = 50
-        TEST = 1
+        TEST_BATCH_SIZE = 50
         TRAIN_OR_TEST = 0
         NUM_CHANNELS = 3
-        first_time_load = 1
 
         mask_dir = parent_dir
         weights_dir = parent_dir
-        LOCAL_TEST = 1
 
 
         file_name_part = compute_file_name(cRates)
 
+        # a run continues from the masks and weights saved under its own
+        # rates, or with -save from those of the previous rates
+        # (-org_file_name); the first run starts from bvlc_alexnet
         if (save_for_next_iter):
-            (weights_mask, biases_mask)= initialize_weights_mask(first_time_load, mask_dir, 'mask'+org_file_name + '.pkl')
+            state_name = org_file_name
         else:
-            (weights_mask, biases_mask)= initialize_weights_mask(first_time_load, mask_dir, 'mask'+file_name_part + '.pkl')
+            state_name = file_name_part
+        (weights_mask, biases_mask)= initialize_weights_mask(first_time_load, mask_dir, 'mask'+state_name + '.pkl')
+        checkpoint = 'weights' + file_name_part + '.weights'
+        weights_path = weights_dir + 'weights' + state_name + '.weights'
+        if (first_time_load or not os.path.exists(weights_path)):
+            print('no saved weights for {}, starting from bvlc_alexnet'.format(state_name))
+            weights_path = 'DEFAULT'
 
 
         meta_data_dir = '/local/scratch/share/ImageNet/ILSVRC/Data/CLS-LOC'
@@ -301,18 +418,32 @@ def main(argv = None):
         #                                             weights_dir + 'weights' + file_name_part + '.pkl')
         #
 
-        x = tf.placeholder(tf.float32, [batch_size, 227, 227, 3])
-        y = tf.placeholder(tf.float32, [None, num_classes])
+        if (TRAIN and TF_DATA):
+            # batches are decoded by the runtime and go straight into the model
+            x, y = input_pipeline.class_list_batches(train_file_txt, batch_size, num_classes,
+                                                     horizontal_flip = True, shuffle = True,
+                                                     sparse_labels = SPARSE_LABELS)
+        else:
+            x = tf.placeholder(tf.float32, [None, 227, 227, 3])
+            if (SPARSE_LABELS):
+                # int class ids, saves feeding a num_classes wide one hot matrix
+                y = tf.placeholder(tf.int32, [None])
+            else:
+                y = tf.placeholder(tf.float32, [None, num_classes])
         keep_prob = tf.placeholder(tf.float32)
 
         # initilize the model from the class constructer
-        model = AlexNet(x, keep_prob, num_classes)
+        model = AlexNet(x, keep_prob, num_classes, weights_path = weights_path,
+                        group_conv = GROUP_CONV, fused = FUSED)
 
         score = model.fc8
         softmax = tf.nn.softmax(score)
 
         with tf.name_scope("cross_ent"):
-            loss = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(logits = score, labels = y))
+            if (SPARSE_LABELS):
+                loss = tf.reduce_mean(tf.nn.sparse_softmax_cross_entropy_with_logits(logits = score, labels = y))
+            else:
+                loss = tf.reduce_mean(tf.nn.softmax_cross_entropy_with_logits(logits = score, labels = y))
 
         with tf.name_scope("train"):
             # l1_norm = lambda_1 * l1
@@ -323,10 +454,21 @@ def main(argv = None):
             # loss_value = tf.reduce_mean(cross_entropy) + regulization_loss
             grads = opt.compute_gradients(loss)
             org_grads = [(ClipIfNotNone(grad), var) for grad, var in grads]
-            train_step = opt.apply_gradients(org_grads)
+            if (ACCUM_STEPS > 1):
+                # effective batch is batch_size * ACCUM_STEPS
+                accum_step, train_step = accumulate_gradients(opt, org_grads, ACCUM_STEPS)
+            else:
+                train_step = opt.apply_gradients(org_grads)
+
+        # encoded test images are preprocessed in the graph
+        encoded_test = tf.placeholder(tf.string, [None])
+        decoded_test = input_pipeline.preprocess_batch(encoded_test)
 
         with tf.name_scope("accuracy"):
-            correct_prediction = tf.equal(tf.argmax(score,1), tf.argmax(y,1))
+            if (SPARSE_LABELS):
+                correct_prediction = tf.nn.in_top_k(score, y, 1)
+            else:
+                correct_prediction = tf.equal(tf.argmax(score,1), tf.argmax(y,1))
             accuracy = tf.reduce_mean(tf.cast(correct_prediction, tf.float32))
 
         # keys = ['cov1', 'cov2', 'fc1', 'fc2', 'fc3']
@@ -338,7 +480,8 @@ def main(argv = None):
         # cross_entropy = tf.nn.softmax_cross_entropy_with_logits(logits = pred, labels = y)
         #
 
-        # new_grads = mask_gradients(weights, org_grads, weights_mask, biases, biases_mask, WITH_BIASES)
+        # gradients are masked in the graph: AlexNet uses weights * weights_mask
+        # (alexnet.masked_weights), so pruned weights get zero gradients
 
         # Apply gradients.
 
@@ -350,42 +493,101 @@ def main(argv = None):
         # Launch the graph
         print('Graph launching ..')
 
-        if (TRAIN):
+        if (TRAIN and PACKED_PREFIX):
+            # training set packed once with datagenerator.pack_class_list
+            train_generator = PackedDataGenerator(PACKED_PREFIX,
+                                                  horizontal_flip = True, shuffle = True,
+                                                  nb_classes = num_classes,
+                                                  prefetch = PREFETCH,
+                                                  buffer_ring = 2,
+                                                  sparse_labels = SPARSE_LABELS)
+            val_generator = ImageDataGenerator(val_file_txt, shuffle = False,
+                                               nb_classes = num_classes,
+                                               sparse_labels = SPARSE_LABELS)
+        elif (TRAIN and not TF_DATA):
             train_generator = ImageDataGenerator(train_file_txt,
-                                                 horizontal_flip = True, shuffle = True)
-            val_generator = ImageDataGenerator(val_file_txt, shuffle = False)
+                                                 horizontal_flip = True, shuffle = True,
+                                                 nb_classes = num_classes,
+                                                 prefetch = PREFETCH,
+                                                 num_workers = NUM_WORKERS,
+                                                 buffer_ring = 2,
+                                                 sparse_labels = SPARSE_LABELS,
+                                                 lazy = LAZY_CLASS_LIST)
+            val_generator = ImageDataGenerator(val_file_txt, shuffle = False,
+                                               nb_classes = num_classes,
+                                               sparse_labels = SPARSE_LABELS)
+        elif (TRAIN):
+            # the early stop feeds the validation images in place of the
+            # tf.data batches
+            val_generator = ImageDataGenerator(val_file_txt, shuffle = False,
+                                               nb_classes = num_classes,
+                                               sparse_labels = SPARSE_LABELS)
 
         # test_generator = ImageDataGenerator(test_file_txt, shuffle = False)
 
-        if (TRAIN):
+        if (TRAIN and TF_DATA):
+            train_batches_per_epoch = input_pipeline.count_lines(train_file_txt) // batch_size
+        elif (TRAIN):
             # Get the number of training/validation steps per epoch
             train_batches_per_epoch = np.floor(train_generator.data_size / batch_size).astype(np.int16)
             val_batches_per_epoch = np.floor(val_generator.data_size / batch_size).astype(np.int16)
 
         # test_batches_per_epoch = np.floor(test_generator.data_size / batch_size).astype(np.int16)
 
-        with tf.Session() as sess:
+        # 0 lets TensorFlow use every core, the sweep runner sets a budget
+        config = tf.ConfigProto(intra_op_parallelism_threads = NUM_THREADS,
+                                inter_op_parallelism_threads = NUM_THREADS)
+        with tf.Session(config = config) as sess:
             sess.run(init)
 
 
             model.load_initial_weights(sess)
+            if (not first_time_load):
+                model.mask_weights(weights_mask, sess)
 
             # print('pre train pruning info')
             # prune_info(weights_new, 0)
             # print(78*'-')
             # start = time.time()
+            test_acc = None
             if TRAIN == 1:
                 print("{} Start training...".format(datetime.now()))
+                train_iter = 0
+                stop_training = False
                 for i in range(0,epochs):
+                    if (stop_training):
+                        break
                     for step in range(train_batches_per_epoch):
-                        (batch_x, batch_y) = train_generator.next_batch(batch_size)
-
-                        train_acc, cross_en = sess.run([accuracy, loss_value], feed_dict = {
-                                        x: batch_x,
-                                        y: batch_y,
-                                        keep_prob: 1.0})
-
-                        if (i % DISPLAY_FREQ == 0):
+                        if (TF_DATA):
+                            feed = {keep_prob: dropout}
+                        else:
+                            (batch_x, batch_y) = train_generator.next_batch(batch_size)
+                            feed = {x: batch_x, y: batch_y, keep_prob: dropout}
+
+                        # one forward/backward pass per step; only every
+                        # DISPLAY_FREQ steps an extra forward pass without
+                        # dropout measures the accuracy the early stop uses
+                        if (ACCUM_STEPS > 1):
+                            update_op = accum_step
+                        else:
+                            update_op = train_step
+                        display = (train_iter % DISPLAY_FREQ == 0)
+                        if (display and TF_DATA):
+                            # each run would dequeue its own batch, fetch it
+                            # once so the measured batch is the trained one
+                            (batch_x, batch_y) = sess.run([x, y])
+                            feed = {x: batch_x, y: batch_y, keep_prob: dropout}
+                        if (display):
+                            eval_feed = dict(feed)
+                            eval_feed[keep_prob] = 1.0
+                            train_acc, cross_en = sess.run([accuracy, loss], feed_dict = eval_feed)
+                        _ = sess.run(update_op, feed_dict = feed)
+                        # counted across epochs, a micro batch left over at
+                        # the end of an epoch belongs to the next update
+                        if (ACCUM_STEPS > 1 and (train_iter + 1) % ACCUM_STEPS == 0):
+                            _ = sess.run(train_step)
+
+                        if (display):
                             print('This is the {}th of {}pruning, time is {}'.format(
                                 i,
                                 cRates,
@@ -396,60 +598,78 @@ def main(argv = None):
                                 cross_en
                             ))
                             accuracy_list = np.concatenate((np.array([train_acc]),accuracy_list[0:19]))
-                            if (i%(DISPLAY_FREQ*50) == 0 and i != 0 ):
+                            if (train_iter%(DISPLAY_FREQ*50) == 0 and train_iter != 0 ):
                                 train_acc_list.append(train_acc)
                                 # file_name_part = compute_file_name(cRates)
                                 # save_pkl_model(weights, biases, weights_dir, 'weights' + file_name_part + '.pkl')
                                 # print("saved the network")
                             if (np.mean(accuracy_list) > 0.81 and train_acc >= 0.83):
                                 accuracy_list = np.zeros(20)
-                                test_acc = sess.run(accuracy, feed_dict = {
-                                                        x: images_test,
-                                                        y: labels_test,
-                                                        keep_prob: 1.0})
-                                print('test accuracy is {}'.format(test_acc))
-                                if (test_acc > 0.823):
+                                val_acc = evaluate(sess, accuracy, x, y, keep_prob,
+                                                   val_generator, TEST_BATCH_SIZE)
+                                print('validation accuracy is {}'.format(val_acc))
+                                if (val_acc > 0.823):
                                     print("training accuracy is large, show the list: {}".format(accuracy_list))
+                                    stop_training = True
                                     break
-
-                        _ = sess.run(train_step, feed_dict = {
-                                        x: batch_x,
-                                        y: batch_y,
-                                        keep_prob: dropout})
+                        train_iter += 1
+
+                if (not TF_DATA):
+                    train_generator.close()
+                val_generator.close()
+
+                save_checkpoint(model.weight_variables(), model.bias_variables(),
+                                weights_dir, checkpoint)
+
+                # the pruned network, only the kept weights are written
+                save_compressed_model(model.weight_variables(), model.bias_variables(),
+                                      model.mask_variables(), weights_dir,
+                                      'pruned' + file_name_part + '.npz')
+                print('saved the pruned network')
+
+            if (PRUNE):
+                # masks are updated inside the session, one op for all layers
+                prune_layers = sorted(cRates)
+                start = time.time()
+                sess.run(model.prune_op(prune_layers), feed_dict = dict(
+                    (model.prune_rates[key], cRates[key]) for key in prune_layers))
+                print('prune step took {:.3f}s'.format(time.time() - start))
+                weights_mask = pack_masks(sess.run(model.mask_variables()))
+                with open(mask_dir + 'mask' + file_name_part + '.pkl', 'wb') as f:
+                    pickle.dump((weights_mask, biases_mask), f)
+                if (weights_path != weights_dir + checkpoint):
+                    # hand the weights over to the runs of these rates
+                    save_checkpoint(model.weight_variables(), model.bias_variables(),
+                                    weights_dir, checkpoint)
 
             if (TEST):
-                test_acc_list = []
-
-                if (LOCAL_TEST == 1):
-                    image_dir = "cpu_test_data/tmp_images/"
-                    imagenet_mean = np.array([104., 117., 124.], dtype = np.float32)
-                    test_batches_per_epoch = 3
-                    img_files = [os.path.join(image_dir, f) for f in os.listdir(image_dir) if f.endswith('.jpeg')]
-                    imgs_test = []
-                    for i,f in enumerate(img_files):
-                        tmp = cv2.imread(f)
-                        tmp = cv2.resize(tmp.astype(np.float32), (227,227))
-                        tmp -= imagenet_mean[i]
-                        tmp = tmp.reshape((1,227,227,3))
-                        imgs_test.append(tmp)
-
-
-
-                if (LOCAL_TEST):
-                    names = []
-                    probs = []
-
-                    for step in range(test_batches_per_epoch):
-                        prob = sess.run(softmax, feed_dict = {
-                                                x: imgs_test[step],
-                                                # y: labels_test,
-                                                keep_prob: 1.0})
-                        name = class_names[np.argmax(prob)]
-                        probs.append(np.max(prob))
-                        names.append(name)
-                    print("names are {}".format(names))
-                    print("probs are {}".format(probs))
-                    sys.exit()
+                # the labelled test list, the accuracy is what main returns
+                test_generator = ImageDataGenerator(test_file_txt, shuffle = False,
+                                                    nb_classes = num_classes,
+                                                    sparse_labels = SPARSE_LABELS)
+                test_acc = evaluate(sess, accuracy, x, y, keep_prob,
+                                    test_generator, TEST_BATCH_SIZE)
+                test_generator.close()
+                print('test accuracy is {}'.format(test_acc))
+
+            if (LOCAL_TEST):
+                # top-1 names of the unlabelled images in cpu_test_data
+                image_dir = "cpu_test_data/tmp_images/"
+                img_files = [os.path.join(image_dir, f) for f in os.listdir(image_dir) if f.endswith('.jpeg')]
+                names = []
+                probs = []
+                for f in img_files:
+                    # same in-graph decode/resize/BGR/mean stage as inference
+                    with open(f, 'rb') as img_file:
+                        img = sess.run(decoded_test, feed_dict = {
+                                            encoded_test: [img_file.read()]})
+                    prob = sess.run(softmax, feed_dict = {
+                                            x: img,
+                                            keep_prob: 1.0})
+                    names.append(class_names[np.argmax(prob)])
+                    probs.append(np.max(prob))
+                print("names are {}".format(names))
+                print("probs are {}".format(probs))
             # if (save_for_next_iter):
             #     print('saving for the next iteration of dynamic surgery')
             #     file_name_part = compute_file_name(cRates)
@@ -477,10 +697,11 @@ def main(argv = None):
             #                     'mask' + f_name + '.pkl')
             #     file_name_part = compute_file_name(cRates)
             #     save_pkl_model(weights, biases, weights_dir, 'weights' + file_name_part + '.pkl')
-            # return test_acc
-    except Usage, err:
-        print >> sys.stderr, err.msg
-        print >> sys.stderr, "for help use --help"
+        return test_acc
+    except Usage as err:
+        sys.stderr.write(err.msg + '\n')
+        sys.stderr.write("for help use --help\n")
         return
 if __name__ == '__main__':
-    sys.exit(main())
+    # main returns the test accuracy, not an exit status
+    main()
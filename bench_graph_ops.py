@@ -0,0 +1,109 @@
+################################################################################
+#Graph size and per-op time of the standard vs the fused conv layers
+#
+#Builds the forward pass of alexnet.AlexNet and of alexnet_predictor.forward
+#with random weights, once as before and once with fused = True, and prints
+#for both the number of ops of every type in the forward subgraph and the
+#time the runtime spent per op type (from a traced run, after the graph
+#optimizer had its turn, so fused kernels such as _FusedConv2D show up).
+#Only the conv layers differ between the modes, the fc ops are the same.
+#
+#usage: python bench_graph_ops.py [--batch_size 16] [--runs 10]
+################################################################################
+
+import argparse
+import collections
+import time
+
+import numpy as np
+import tensorflow as tf
+
+from alexnet import AlexNet, LAYER_NAMES
+from alexnet_predictor import create_variables, forward
+
+# (in, out) / HWIO shapes of bvlc_alexnet.npy
+SHAPES = {
+    'conv1': (11, 11, 3, 96), 'conv2': (5, 5, 48, 256), 'conv3': (3, 3, 256, 384),
+    'conv4': (3, 3, 192, 384), 'conv5': (3, 3, 192, 256),
+    'fc6': (9216, 4096), 'fc7': (4096, 4096), 'fc8': (4096, 1000),
+}
+
+def random_net_data(rng):
+    return dict((name, [rng.randn(*SHAPES[name]).astype(np.float32) * 0.01,
+                        np.zeros(SHAPES[name][-1], dtype = np.float32)]) for name in LAYER_NAMES)
+
+def op_counts(graph, output):
+    """
+    {op type: count} of the ops output depends on
+    """
+    sub_graph = tf.graph_util.extract_sub_graph(graph.as_graph_def(), [output.op.name])
+    return collections.Counter(node.op for node in sub_graph.node)
+
+def op_times(sess, output, feed_dict):
+    """
+    {op type: microseconds} of one traced run
+    """
+    run_metadata = tf.RunMetadata()
+    sess.run(output, feed_dict = feed_dict,
+             options = tf.RunOptions(trace_level = tf.RunOptions.FULL_TRACE),
+             run_metadata = run_metadata)
+    times = collections.Counter()
+    for dev_stats in run_metadata.step_stats.dev_stats:
+        for node_stats in dev_stats.node_stats:
+            # timeline_label reads "<name> = <OpType>(<inputs>)"
+            label = node_stats.timeline_label
+            op_type = label.split(' = ')[1].split('(')[0] if ' = ' in label else node_stats.node_name
+            times[op_type] += node_stats.all_end_rel_micros
+    return times
+
+def build(builder, fused, rng):
+    """
+    A graph with an image placeholder, the logits of the given builder and an
+    initialized session
+    """
+    graph = tf.Graph()
+    with graph.as_default():
+        x = tf.placeholder(tf.float32, [None, 227, 227, 3])
+        init_feed = {}
+        if builder == 'alexnet':
+            logits = AlexNet(x, 1., 1000, fused = fused).fc8
+        else:
+            variables, init_feed, _ = create_variables(random_net_data(rng))
+            logits = forward(x, variables, fused = fused)
+        sess = tf.Session(graph = graph)
+        sess.run(tf.global_variables_initializer(), feed_dict = init_feed)
+    return graph, sess, x, logits
+
+def main():
+    parser = argparse.ArgumentParser(description = 'op counts and per-op timing of the fused conv layers')
+    parser.add_argument('--batch_size', type = int, default = 16)
+    parser.add_argument('--runs', type = int, default = 10)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(0)
+    batch = rng.randn(args.batch_size, 227, 227, 3).astype(np.float32)
+    for builder in ['alexnet', 'predictor']:
+        counts = {}
+        times = {}
+        for fused in [False, True]:
+            graph, sess, x, logits = build(builder, fused, rng)
+            counts[fused] = op_counts(graph, logits)
+            feed_dict = {x: batch}
+            sess.run(logits, feed_dict = feed_dict)
+            times[fused] = op_times(sess, logits, feed_dict)
+            start = time.time()
+            for _ in range(args.runs):
+                sess.run(logits, feed_dict = feed_dict)
+            print('{} fused={}: {} ops, {:.1f} ms per batch'.format(
+                builder, fused, sum(counts[fused].values()), (time.time() - start) / args.runs * 1000.))
+            sess.close()
+
+        print('  {:20s} {:>8s} {:>8s} {:>12s} {:>12s}'.format('op', 'count', 'fused', 'us', 'fused us'))
+        for op_type in sorted(set(counts[False]) | set(counts[True]) | set(times[False]) | set(times[True])):
+            print('  {:20s} {:8d} {:8d} {:12d} {:12d}'.format(
+                op_type, counts[False][op_type], counts[True][op_type],
+                times[False][op_type], times[True][op_type]))
+
+
+if __name__ == '__main__':
+    main()
@@ -1,3 +1,5 @@
+import numpy as np
+
 class_names = '''tench, Tinca tinca
 goldfish, Carassius auratus
 great white shark, white shark, man-eater, man-eating shark, Carcharodon carcharias
@@ -997,4 +999,23 @@ earthstar
 hen-of-the-woods, hen of the woods, Polyporus frondosus, Grifola frondosa
 bolete
 ear, spike, capitulum
-toilet tissue, toilet paper, bathroom tissue'''.split("\n")
\ No newline at end of file
+toilet tissue, toilet paper, bathroom tissue'''.split("\n")
+
+
+# Lookup tables for batched decoding: class_name_array[inds] names a whole
+# (N, k) index array in one go. The short names keep only the first synonym
+class_name_array = np.array(class_names)
+short_names = [name.split(',')[0] for name in class_names]
+short_name_array = np.array(short_names)
+
+def top_k(prob, k = 5):
+    """
+    Indices and values of the k largest entries of every row of prob, sorted
+    by decreasing value. argpartition only sorts the k winners, not all 1000
+    classes
+    """
+    prob = np.asarray(prob)
+    inds = np.argpartition(-prob, k - 1, axis = 1)[:, :k]
+    top = np.take_along_axis(prob, inds, axis = 1)
+    order = np.argsort(-top, axis = 1)
+    return np.take_along_axis(inds, order, axis = 1), np.take_along_axis(top, order, axis = 1)
@@ -1,5 +1,10 @@
 import numpy as np
 import cv2
+import multiprocessing
+import mmap
+import sys
+import threading
+import queue
 
 """
 This code is highly influenced by the implementation of:
@@ -11,10 +16,142 @@ Keras library. But as I needed BGR color format for fine-tuneing AlexNet I
 wrote my own little generator.
 """
 
+# the decode pools are spawned: the prefetch pool starts inside the training
+# session, and forking a process that already runs TensorFlow threads can
+# leave the child deadlocked on a lock held by one of them
+_mp_context = multiprocessing.get_context('spawn')
+
+def _init_worker():
+    """
+    Keep every prefetch worker on a single OpenCV thread, the parallelism
+    comes from the worker pool itself
+    """
+    cv2.setNumThreads(1)
+
+def _resize_bilinear(img, scale_size):
+    """
+    Bilinear rescale with the sampling of tf.image.resize_images under its
+    TF1 defaults (no align_corners, no half pixel centers), so that training
+    images match input_pipeline.preprocess_image at inference. Returns float32
+    """
+    def taps(in_size, out_size):
+        pos = np.arange(out_size, dtype = np.float32) * np.float32(in_size / float(out_size))
+        lower = np.floor(pos).astype(np.int64)
+        upper = np.minimum(lower + 1, in_size - 1)
+        return lower, upper, (pos - lower).astype(np.float32)
+
+    y0, y1, y_lerp = taps(img.shape[0], scale_size[0])
+    x0, x1, x_lerp = taps(img.shape[1], scale_size[1])
+    img = img.astype(np.float32)
+    x_lerp = x_lerp[None, :, None]
+    top = img[y0][:, x0] + (img[y0][:, x1] - img[y0][:, x0]) * x_lerp
+    bottom = img[y1][:, x0] + (img[y1][:, x1] - img[y1][:, x0]) * x_lerp
+    return top + (bottom - top) * y_lerp[:, None, None]
+
+def _load_image(args, out = None):
+    """
+    Read, flip and rescale a single image to float32 BGR, or round it into
+    the uint8 array out when that is given. This lives at module level so
+    that it can be shipped to the prefetch worker processes
+    """
+    path, flip, scale_size = args
+    # tf.image.decode_image does not apply the EXIF orientation either
+    img = cv2.imread(path, cv2.IMREAD_COLOR | cv2.IMREAD_IGNORE_ORIENTATION)
+    if img is None:
+        raise IOError('could not read image {}'.format(path))
+
+    #flip image if selected
+    if flip:
+        img = cv2.flip(img, 1)
+
+    #rescale image
+    img = _resize_bilinear(img, scale_size)
+    if out is None:
+        return img
+    out[...] = np.rint(img)
+    return out
+
+def pack_class_list(class_list, pack_prefix, imgs_parent_dir = '',
+                    scale_size = (227, 227), num_workers = None):
+    """
+    Decode and rescale every image of a class list once and write the uint8
+    BGR pixels into <pack_prefix>_images.npy, a single contiguous array that
+    PackedDataGenerator memory-maps, with the int labels in
+    <pack_prefix>_labels.npy
+    """
+    with open(class_list) as f:
+        lines = [l.split() for l in f if l.strip()]
+    jobs = [(imgs_parent_dir + items[0], False, scale_size) for items in lines]
+    labels = np.array([int(items[1]) for items in lines], dtype = np.int32)
+
+    images = np.lib.format.open_memmap(pack_prefix + '_images.npy', mode = 'w+',
+                                       dtype = np.uint8,
+                                       shape = (len(jobs), scale_size[0], scale_size[1], 3))
+    pool = _mp_context.Pool(num_workers, initializer = _init_worker)
+    try:
+        for i, img in enumerate(pool.imap(_load_image, jobs, chunksize = 64)):
+            images[i] = np.rint(img)
+    finally:
+        pool.terminate()
+        pool.join()
+    images.flush()
+    del images
+
+    np.save(pack_prefix + '_labels.npy', labels)
+
+class ClassListIndex:
+    """
+    Lazy view of a class list file. Only the byte offsets of the lines are
+    kept in memory (a compact integer array), paths and labels are parsed out
+    of the memory-mapped text when a batch asks for them. The list can be
+    sharded so that worker <rank> of <num_shards> only sees every
+    num_shards-th line
+    """
+    def __init__(self, class_list, rank = 0, num_shards = 1):
+        with open(class_list, 'rb') as f:
+            self._text = mmap.mmap(f.fileno(), 0, access = mmap.ACCESS_READ)
+        buf = np.frombuffer(self._text, dtype = np.uint8)
+
+        # line boundaries from a single vectorized scan for newlines
+        ends = np.flatnonzero(buf == ord('\n'))
+        if len(buf) and buf[-1] != ord('\n'):
+            ends = np.append(ends, len(buf))
+        starts = np.concatenate(([0], ends[:-1] + 1))
+
+        # drop blank lines, keep the offsets as small as the file allows
+        keep = ends - starts > 1
+        offset_dtype = np.uint32 if len(buf) < 2**32 else np.int64
+        self.starts = starts[keep][rank::num_shards].astype(offset_dtype)
+        self.ends = ends[keep][rank::num_shards].astype(offset_dtype)
+        del buf
+
+    def __len__(self):
+        return len(self.starts)
+
+    def lookup(self, idx):
+        """
+        Parse the paths and int labels of the given lines
+        """
+        paths = []
+        labels = np.empty(len(idx), dtype = np.int32)
+        for i, j in enumerate(idx):
+            items = self._text[self.starts[j]:self.ends[j]].split()
+            paths.append(items[0].decode())
+            labels[i] = int(items[1])
+        return paths, labels
+
+    def close(self):
+        self._text.close()
+
 class ImageDataGenerator:
+    # whether batches are decoded on the prefetch process pool
+    _uses_pool = True
+
     def __init__(self, class_list, horizontal_flip=False, shuffle=False,
                  mean = np.array([104., 117., 124.]), scale_size=(227, 227),
-                 nb_classes = 2):
+                 nb_classes = 2, imgs_parent_dir = '', prefetch = 0,
+                 num_workers = None, buffer_ring = 0, buffer_dtype = np.float32,
+                 sparse_labels = False, lazy = False, rank = 0, num_shards = 1):
 
         # Init params
         self.horizontal_flip = horizontal_flip
@@ -22,8 +159,36 @@ class ImageDataGenerator:
         self.shuffle = shuffle
         self.mean = mean
         self.scale_size = scale_size
+        # emit int labels instead of one hot rows (for sparse cross entropy)
+        self.sparse_labels = sparse_labels
+        self.imgs_parent_dir = imgs_parent_dir
         self.pointer = 0
 
+        # Class list params: lazy keeps only line offsets of the list in
+        # memory, rank/num_shards select this worker's share of the lines
+        self.lazy = lazy
+        self.rank = rank
+        self.num_shards = num_shards
+        self.class_index = None
+
+        # Prefetch params: number of ready batches to keep queued (0 disables
+        # prefetching) and size of the decode worker pool
+        self.prefetch = prefetch
+        self.num_workers = num_workers
+        self._pool = None
+        self._producer = None
+        self._batch_queue = None
+        self._stop_event = None
+        self._prefetch_batch_size = None
+
+        # Buffer params: number of preallocated batch buffers to cycle through
+        # (0 allocates fresh float64 arrays per batch) and their dtype. uint8
+        # buffers hold the raw BGR pixels and leave mean subtraction to the graph
+        self.buffer_ring = buffer_ring
+        self.buffer_dtype = np.dtype(buffer_dtype)
+        self._buffers = []
+        self._buffer_index = 0
+
         self.read_class_list(class_list)
 
         if self.shuffle:
@@ -33,77 +198,289 @@ class ImageDataGenerator:
         """
         Scan the image file and get the image paths and labels
         """
+        if self.lazy:
+            self.class_index = ClassListIndex(class_list, self.rank, self.num_shards)
+            self.data_size = len(self.class_index)
+            self.order = np.arange(self.data_size)
+            return
+
         with open(class_list) as f:
-            lines = f.readlines()
-            self.images = []
-            self.labels = []
-            for l in lines:
+            images = []
+            labels = []
+            for l in f:
                 items = l.split()
-                self.images.append(items[0])
-                self.labels.append(int(items[1]))
+                if not items:
+                    continue
+                images.append(items[0])
+                labels.append(int(items[1]))
 
-            #store total number of data
-            self.data_size = len(self.labels)
+        shard = slice(self.rank, None, self.num_shards)
+        self.images = np.array(images)[shard]
+        self.labels = np.array(labels, dtype = np.int32)[shard]
+        self.order = np.arange(len(self.labels))
+
+        #store total number of data
+        self.data_size = len(self.labels)
 
     def shuffle_data(self):
         """
-        Random shuffle the images and labels
+        Random shuffle the images and labels, by permuting the index order
         """
-        images = self.images.copy()
-        labels = self.labels.copy()
-        self.images = []
-        self.labels = []
-
-        #create list of permutated index and shuffle data accoding to list
-        idx = np.random.permutation(len(labels))
-        for i in idx:
-            self.images.append(images[i])
-            self.labels.append(labels[i])
+        self.order = np.random.permutation(self.data_size)
 
     def reset_pointer(self):
         """
         reset pointer to begin of the list
         """
+        # the producer thread owns the pointer while prefetching
+        self.stop_prefetch()
+
         self.pointer = 0
 
         if self.shuffle:
             self.shuffle_data()
 
 
-    def next_batch(self, batch_size, imgs_parent_dir):
+    def next_batch(self, batch_size, imgs_parent_dir = None):
         """
         This function gets the next n ( = batch_size) images from the path list
-        and labels and loads the images into them into memory
+        and labels and loads the images into them into memory. With prefetching
+        enabled the batch comes from the queue filled by the background workers
+        """
+        if imgs_parent_dir is not None and imgs_parent_dir != self.imgs_parent_dir:
+            self.stop_prefetch()
+            self.imgs_parent_dir = imgs_parent_dir
+
+        if not self.prefetch:
+            return self._read_batch(batch_size)
+
+        if self._producer is None or self._prefetch_batch_size != batch_size:
+            self.stop_prefetch()
+            self._start_prefetch(batch_size)
+
+        batch = self._batch_queue.get()
+        if isinstance(batch, Exception):
+            # the producer died on this error, a later call starts a new one
+            self.stop_prefetch()
+            raise batch
+        return batch
+
+    def _read_batch(self, batch_size, pool = None):
+        """
+        Read the next batch from disk, decoding with the given worker pool if
+        there is one
         """
         # Get next batch of image (path) and labels
-        paths = self.images[self.pointer:self.pointer + batch_size]
-        labels = self.labels[self.pointer:self.pointer + batch_size]
+        idx = self.order[self.pointer:self.pointer + batch_size]
+        if self.class_index is not None:
+            paths, labels = self.class_index.lookup(idx)
+        else:
+            paths = self.images[idx]
+            labels = self.labels[idx]
 
         #update pointer
         self.pointer += batch_size
 
-        # Read images
-        images = np.ndarray([batch_size, self.scale_size[0], self.scale_size[1], 3])
-        for i in range(len(paths)):
-            img = cv2.imread(parent_dir + paths[i])
+        # Decide the random flips here so the workers stay deterministic
+        jobs = []
+        for path in paths:
+            flip = self.horizontal_flip and np.random.random() < 0.5
+            jobs.append((self.imgs_parent_dir + path, flip, self.scale_size))
+
+        images, batch_labels = self._batch_buffers(batch_size)
+
+        # Read images, straight into the batch buffer when it holds raw pixels
+        if pool is None:
+            for i, job in enumerate(jobs):
+                if images.dtype == np.uint8:
+                    _load_image(job, out = images[i])
+                else:
+                    self._store_image(images, i, _load_image(job))
+        else:
+            for i, img in enumerate(pool.map(_load_image, jobs)):
+                self._store_image(images, i, img)
+
+        self._encode_labels(labels, batch_labels)
+
+        #return array of images and labels
+        return images, batch_labels
+
+    def _store_image(self, images, i, img):
+        """
+        Copy a decoded image into slot i of the batch, subtracting the mean
+        on the way unless the batch holds raw pixels
+        """
+        if images.dtype == np.uint8:
+            images[i] = np.rint(img)
+        else:
+            np.subtract(img, self.mean, out = images[i])
+
+    def _encode_labels(self, labels, out):
+        """
+        Write the int labels of a batch into its zeroed label array, either
+        as they are or expanded to one hot encoding
+        """
+        if self.sparse_labels:
+            out[:len(labels)] = labels
+        else:
+            out[np.arange(len(labels)), labels] = 1
+
+    def _batch_buffers(self, batch_size):
+        """
+        Return the image array and zeroed label array for the next batch. With
+        a buffer ring these are reused, so a batch is only valid until the
+        ring wraps around
+        """
+        shape = [batch_size, self.scale_size[0], self.scale_size[1], 3]
+        if self.sparse_labels:
+            label_shape, label_dtype = (batch_size,), np.int32
+        else:
+            label_shape, label_dtype = (batch_size, self.n_classes), np.float32
+        if not self.buffer_ring:
+            if not self.sparse_labels:
+                label_dtype = np.float64
+            return np.ndarray(shape), np.zeros(label_shape, dtype = label_dtype)
+
+        # queued batches and the one held by the caller must not be overwritten
+        ring_size = self.buffer_ring
+        if self.prefetch:
+            ring_size = max(ring_size, self.prefetch + 2)
+
+        if len(self._buffers) != ring_size or self._buffers[0][0].shape[0] != batch_size:
+            self._buffers = [(np.zeros(shape, dtype = self.buffer_dtype),
+                              np.zeros(label_shape, dtype = label_dtype))
+                             for _ in range(ring_size)]
+            self._buffer_index = 0
+
+        images, labels = self._buffers[self._buffer_index]
+        self._buffer_index = (self._buffer_index + 1) % ring_size
+        labels.fill(0)
+        return images, labels
+
+    def _start_prefetch(self, batch_size):
+        """
+        Spin up the decode pool and the thread that keeps the queue filled
+        """
+        if self._pool is None and self._uses_pool:
+            self._pool = _mp_context.Pool(self.num_workers,
+                                              initializer = _init_worker)
+        self._batch_queue = queue.Queue(maxsize = self.prefetch)
+        self._stop_event = threading.Event()
+        self._prefetch_batch_size = batch_size
+        self._producer = threading.Thread(target = self._produce,
+                                          args = (batch_size,))
+        self._producer.daemon = True
+        self._producer.start()
+
+    def _produce(self, batch_size):
+        """
+        Producer loop, wraps around (and reshuffles) at the end of the list
+        """
+        while not self._stop_event.is_set():
+            if self.pointer + batch_size > self.data_size:
+                self.pointer = 0
+                if self.shuffle:
+                    self.shuffle_data()
+
+            try:
+                batch = self._read_batch(batch_size, self._pool)
+            except Exception as e:
+                # hand the error to next_batch instead of leaving it blocked
+                self._put(e)
+                return
+            self._put(batch)
+
+    def _put(self, item):
+        """
+        Block on a full queue but keep checking for a stop request
+        """
+        while not self._stop_event.is_set():
+            try:
+                self._batch_queue.put(item, timeout = 0.1)
+                return
+            except queue.Full:
+                pass
+
+    def stop_prefetch(self):
+        """
+        Stop the producer thread, batches still queued are dropped
+        """
+        if self._producer is None:
+            return
+        self._stop_event.set()
+        self._producer.join()
+        self._producer = None
+        self._batch_queue = None
+        self._prefetch_batch_size = None
+
+    def close(self):
+        """
+        Release the prefetch thread, the worker pool and the mapped class list
+        """
+        self.stop_prefetch()
+        if self.class_index is not None:
+            self.class_index.close()
+            self.class_index = None
+        if self._pool is not None:
+            self._pool.terminate()
+            self._pool.join()
+            self._pool = None
+
+
+class PackedDataGenerator(ImageDataGenerator):
+    """
+    Serves batches from a dataset written by pack_class_list. Images are
+    sliced out of the memory-mapped pixel array, so after the first epoch has
+    pulled the file into the page cache no JPEG is decoded at all
+    """
+    _uses_pool = False
+
+    def __init__(self, pack_prefix, horizontal_flip=False, shuffle=False,
+                 mean = np.array([104., 117., 124.]), nb_classes = 2,
+                 prefetch = 0, buffer_ring = 0, buffer_dtype = np.float32,
+                 sparse_labels = False):
+        ImageDataGenerator.__init__(self, pack_prefix,
+                                    horizontal_flip = horizontal_flip,
+                                    shuffle = shuffle, mean = mean,
+                                    nb_classes = nb_classes, prefetch = prefetch,
+                                    buffer_ring = buffer_ring,
+                                    buffer_dtype = buffer_dtype,
+                                    sparse_labels = sparse_labels)
+
+    def read_class_list(self, pack_prefix):
+        """
+        Map the packed pixels and load the labels
+        """
+        self.images = np.load(pack_prefix + '_images.npy', mmap_mode = 'r')
+        self.labels = np.load(pack_prefix + '_labels.npy')
+        self.scale_size = self.images.shape[1:3]
+        self.data_size = len(self.labels)
+        self.order = np.arange(self.data_size)
+
+    def _read_batch(self, batch_size, pool = None):
+        """
+        Slice the next batch out of the memory map
+        """
+        idx = self.order[self.pointer:self.pointer + batch_size]
+
+        #update pointer
+        self.pointer += batch_size
+
+        images, batch_labels = self._batch_buffers(batch_size)
+        for i, j in enumerate(idx):
+            img = self.images[j]
 
             #flip image at random if flag is selected
             if self.horizontal_flip and np.random.random() < 0.5:
-                img = cv2.flip(img, 1)
+                img = img[:, ::-1]
 
-            #rescale image
-            img = cv2.resize(img, (self.scale_size[0], self.scale_size[0]))
-            img = img.astype(np.float32)
+            self._store_image(images, i, img)
 
-            #subtract mean
-            img -= self.mean
+        self._encode_labels(self.labels[idx], batch_labels)
 
-            images[i] = img
+        return images, batch_labels
 
-        # Expand labels to one hot encoding
-        one_hot_labels = np.zeros((batch_size, self.n_classes))
-        for i in range(len(labels)):
-            one_hot_labels[i][labels[i]] = 1
 
-        #return array of images and labels
-        return images, one_hot_labels
+if __name__ == '__main__':
+    # usage: python datagenerator.py <class_list> <pack_prefix> [imgs_parent_dir]
+    pack_class_list(*sys.argv[1:4])
@@ -0,0 +1,89 @@
+import tensorflow as tf
+import numpy as np
+
+"""
+TensorFlow-native counterpart of datagenerator.ImageDataGenerator. It reads
+the same class list files ("<path> <label>" per line) but decodes, flips,
+rescales and mean-subtracts inside the runtime on a pool of CPU threads, and
+hands batches to the model as tensors so nothing goes through feed_dict.
+"""
+
+def count_lines(class_list):
+  """
+  Number of (non blank) entries in a class list
+  """
+  with open(class_list) as f:
+    return sum(1 for l in f if l.strip())
+
+def preprocess_image(encoded, scale_size = (227, 227), mean = np.array([104., 117., 124.]),
+                     horizontal_flip = False):
+  """
+  The single preprocessing stage shared by training and inference: decode
+  JPEG/PNG bytes, optionally flip, rescale, swap RGB -> BGR and subtract the
+  per-channel BGR mean
+  """
+  img = tf.image.decode_image(encoded, channels = 3)
+  img.set_shape([None, None, 3])
+
+  #flip image at random if flag is selected
+  if horizontal_flip:
+    img = tf.image.random_flip_left_right(img)
+
+  #rescale image
+  img = tf.image.resize_images(img, scale_size)
+  img.set_shape([scale_size[0], scale_size[1], 3])
+
+  # RGB -> BGR and subtract mean
+  return tf.reverse(img, axis = [-1]) - tf.constant(mean, dtype = tf.float32)
+
+def preprocess_batch(encoded, scale_size = (227, 227), mean = np.array([104., 117., 124.]),
+                     parallel_iterations = 8):
+  """
+  preprocess_image over a 1-D string tensor of encoded images, decoded in
+  parallel by the runtime
+  """
+  with tf.device('/cpu:0'), tf.name_scope('preprocess'):
+    return tf.map_fn(lambda e: preprocess_image(e, scale_size, mean), encoded,
+                     dtype = tf.float32, parallel_iterations = parallel_iterations,
+                     back_prop = False)
+
+def parse_line(line, imgs_parent_dir, scale_size, mean, horizontal_flip):
+  """
+  Turn one class list line into a mean subtracted BGR float image and its
+  int label, matching what ImageDataGenerator produces
+  """
+  items = tf.string_split([line], delimiter = ' ').values
+  label = tf.string_to_number(items[1], out_type = tf.int32)
+
+  img = preprocess_image(tf.read_file(imgs_parent_dir + items[0]), scale_size, mean,
+                         horizontal_flip)
+
+  return img, label
+
+def class_list_batches(class_list, batch_size, num_classes, imgs_parent_dir = '',
+                       horizontal_flip = False, shuffle = False,
+                       mean = np.array([104., 117., 124.]), scale_size = (227, 227),
+                       sparse_labels = False, num_parallel_calls = 4,
+                       shuffle_buffer = 10000, prefetch = 2):
+  """
+  Build a repeating, prefetched dataset over a class list and return its
+  (images, labels) batch tensors. Labels are one hot unless sparse_labels is
+  set. The whole pipeline is pinned to the CPU
+  """
+  with tf.device('/cpu:0'), tf.name_scope('input_pipeline'):
+    dataset = tf.data.TextLineDataset(class_list)
+    dataset = dataset.filter(lambda line: tf.size(tf.string_split([line]).values) > 0)
+    if shuffle:
+      dataset = dataset.shuffle(shuffle_buffer)
+    dataset = dataset.repeat()
+    dataset = dataset.map(lambda line: parse_line(line, imgs_parent_dir, scale_size,
+                                                  mean, horizontal_flip),
+                          num_parallel_calls = num_parallel_calls)
+    dataset = dataset.batch(batch_size)
+    dataset = dataset.prefetch(prefetch)
+
+    images, labels = dataset.make_one_shot_iterator().get_next()
+    if not sparse_labels:
+      labels = tf.one_hot(labels, num_classes, dtype = tf.float32)
+
+  return images, labels
@@ -28,7 +28,8 @@ from numpy import random
 
 import tensorflow as tf
 
-from caffe_classes import class_names
+from caffe_classes import class_name_array, top_k
+from weight_store import default_weights_path, load_weights_dict
 
 train_x = zeros((1, 227,227,3)).astype(float32)
 train_y = zeros((1, 1000))
@@ -68,7 +69,11 @@ im2[:, :, 0], im2[:, :, 2] = im2[:, :, 2], im2[:, :, 0]
 
 #In Python 3.5, change this to:
 #net_data = load(open("bvlc_alexnet.npy", "rb"), encoding="latin1").item()
-net_data = load("bvlc_alexnet.npy").item()
+#net_data = load("bvlc_alexnet.npy").item()
+#Memory-mapped weights (python weight_store.py bvlc_alexnet.npy bvlc_alexnet.weights)
+#are shared between processes; falls back to the pickle if not converted yet.
+#Containers converted with float16 or bfloat16 are upcast to float32 on load
+net_data = load_weights_dict(default_weights_path())
 
 def conv(input, kernel, biases, k_h, k_w, c_o, s_h, s_w,  padding="VALID", group=1):
     '''From https://github.com/ethereon/caffe-tensorflow
@@ -203,10 +208,11 @@ output = sess.run(prob, feed_dict = {x:[im1,im2]})
 #Output:
 
 
+inds, probs = top_k(output, 5)
+names = class_name_array[inds]
 for input_im_ind in range(output.shape[0]):
-    inds = argsort(output)[input_im_ind,:]
     print "Image", input_im_ind
     for i in range(5):
-        print class_names[inds[-1-i]], output[input_im_ind, inds[-1-i]]
+        print names[input_im_ind, i], probs[input_im_ind, i]
 
 print time.time()-t
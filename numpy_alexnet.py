@@ -0,0 +1,205 @@
+################################################################################
+#TensorFlow-free AlexNet inference
+#
+#The forward pass of myalexnet_forward_newtf.py / alexnet_predictor.forward in
+#plain NumPy, for hosts without a TensorFlow install. Convolutions are im2col
+#(a strided view, copied once into a patch matrix) followed by a single GEMM
+#per group, so nearly all of the time is spent in the BLAS numpy links
+#against, which runs multithreaded (OMP_NUM_THREADS / OPENBLAS_NUM_THREADS /
+#MKL_NUM_THREADS bound the threads). The weights are loaded through
+#weight_store, a .weights container is memory-mapped, so start-up takes
+#milliseconds.
+#
+#usage: python numpy_alexnet.py laska.png poodle.png [--weights ...] [--compare]
+################################################################################
+
+import argparse
+import time
+
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+from caffe_classes import class_name_array, top_k
+from weight_store import LAYER_NAMES, default_weights_path, load_weights_dict
+
+# BGR mean of input_pipeline.preprocess_image
+MEAN = np.array([104., 117., 124.], dtype = np.float32)
+
+def same_padding(size, k, s):
+    """
+    (before, after) padding of TensorFlow's SAME scheme along one axis
+    """
+    out = -(-size // s)
+    total = max((out - 1) * s + k - size, 0)
+    return total // 2, total - total // 2
+
+def im2col(x, k_h, k_w, s_h, s_w):
+    """
+    (N*OH*OW, k_h*k_w*C) patch matrix of an NHWC batch, in the row order of
+    an HWIO kernel reshaped to (k_h*k_w*C, C_out)
+    """
+    n, h, w, c = x.shape
+    out_h = (h - k_h) // s_h + 1
+    out_w = (w - k_w) // s_w + 1
+    sn, sh, sw, sc = x.strides
+    patches = as_strided(x, (n, out_h, out_w, k_h, k_w, c),
+                         (sn, sh * s_h, sw * s_w, sh, sw, sc), writeable = False)
+    return patches.reshape(n * out_h * out_w, k_h * k_w * c), (n, out_h, out_w)
+
+def conv(x, kernel, biases, s_h, s_w, padding = "VALID", group = 1):
+    """
+    Grouped convolution plus bias of an NHWC batch with an HWIO kernel,
+    one GEMM per group
+    """
+    k_h, k_w, c_g, c_o = kernel.shape
+    assert x.shape[-1] == c_g * group
+    if padding == "SAME":
+        pad_h = same_padding(x.shape[1], k_h, s_h)
+        pad_w = same_padding(x.shape[2], k_w, s_w)
+        x = np.pad(x, ((0, 0), pad_h, pad_w, (0, 0)), mode = 'constant')
+    o_g = c_o // group
+    outputs = []
+    for g in range(group):
+        cols, (n, out_h, out_w) = im2col(np.ascontiguousarray(x[..., g * c_g:(g + 1) * c_g]),
+                                         k_h, k_w, s_h, s_w)
+        weights = np.ascontiguousarray(kernel[..., g * o_g:(g + 1) * o_g]).reshape(-1, o_g)
+        outputs.append(np.dot(cols, weights))
+    out = outputs[0] if group == 1 else np.concatenate(outputs, axis = 1)
+    out += biases
+    return out.reshape(n, out_h, out_w, c_o)
+
+def relu(x):
+    return np.maximum(x, 0, out = x)
+
+def lrn(x, radius = 2, alpha = 2e-05, beta = 0.75, bias = 1.0):
+    """
+    tf.nn.local_response_normalization: x / (bias + alpha * sum of squares
+    over the 2 * radius + 1 neighbouring channels) ** beta
+    """
+    sq = np.square(x)
+    # running sum over the channels, windowed by differencing
+    csum = np.cumsum(np.pad(sq, ((0, 0), (0, 0), (0, 0), (radius + 1, radius)), mode = 'constant'),
+                     axis = -1)
+    window = csum[..., 2 * radius + 1:] - csum[..., :-(2 * radius + 1)]
+    return x / (bias + alpha * window) ** beta
+
+def max_pool(x, k = 3, s = 2):
+    """
+    k x k VALID max pooling with stride s, as a maximum over k*k strided slices
+    """
+    n, h, w, c = x.shape
+    out_h = (h - k) // s + 1
+    out_w = (w - k) // s + 1
+    out = x[:, :(out_h - 1) * s + 1:s, :(out_w - 1) * s + 1:s].copy()
+    for i in range(k):
+        for j in range(k):
+            np.maximum(out, x[:, i:i + (out_h - 1) * s + 1:s, j:j + (out_w - 1) * s + 1:s], out = out)
+    return out
+
+def fc(x, weights, biases, relu_out = True):
+    act = np.dot(x, weights)
+    act += biases
+    return relu(act) if relu_out else act
+
+def softmax(logits):
+    e = np.exp(logits - logits.max(axis = 1, keepdims = True))
+    return e / e.sum(axis = 1, keepdims = True)
+
+def forward(x, net_data):
+    """
+    fc8 logits of a (N, 227, 227, 3) BGR float batch, the same layers as
+    alexnet_predictor.forward
+    """
+    x = np.asarray(x, dtype = np.float32)
+    conv1 = relu(conv(x, *net_data["conv1"], s_h = 4, s_w = 4, padding = "SAME", group = 1))
+    maxpool1 = max_pool(lrn(conv1))
+    conv2 = relu(conv(maxpool1, *net_data["conv2"], s_h = 1, s_w = 1, padding = "SAME", group = 2))
+    maxpool2 = max_pool(lrn(conv2))
+    conv3 = relu(conv(maxpool2, *net_data["conv3"], s_h = 1, s_w = 1, padding = "SAME", group = 1))
+    conv4 = relu(conv(conv3, *net_data["conv4"], s_h = 1, s_w = 1, padding = "SAME", group = 2))
+    conv5 = relu(conv(conv4, *net_data["conv5"], s_h = 1, s_w = 1, padding = "SAME", group = 2))
+    maxpool5 = max_pool(conv5)
+    fc6 = fc(maxpool5.reshape(len(x), -1), *net_data["fc6"])
+    fc7 = fc(fc6, *net_data["fc7"])
+    return fc(fc7, *net_data["fc8"], relu_out = False)
+
+def load_image(path, scale_size = (227, 227)):
+    """
+    Decode, rescale, swap RGB -> BGR and subtract the mean, as
+    input_pipeline.preprocess_image does. Needs Pillow
+    """
+    from PIL import Image
+    img = Image.open(path).convert('RGB').resize((scale_size[1], scale_size[0]), Image.BILINEAR)
+    return np.asarray(img, dtype = np.float32)[:, :, ::-1] - MEAN
+
+
+class NumpyAlexNet(object):
+    """
+    AlexNetPredictor's predict/predict_top_k on BGR float batches, without
+    TensorFlow
+    """
+    def __init__(self, weights_path = None, batch_size = 32):
+        # -batch_size: images per forward pass, bounds the im2col buffers
+        if weights_path is None:
+            weights_path = default_weights_path()
+        self.WEIGHTS_PATH = weights_path
+        self.batch_size = batch_size
+
+        net_data = load_weights_dict(weights_path)
+        self.net_data = {}
+        for name in LAYER_NAMES:
+            weights, biases = net_data[name]
+            # float32 memory-mapped tensors pass through without a copy
+            self.net_data[name] = (np.asarray(weights, dtype = np.float32),
+                                   np.asarray(biases, dtype = np.float32))
+
+    def logits(self, batch):
+        return np.concatenate([forward(batch[i:i + self.batch_size], self.net_data)
+                               for i in range(0, len(batch), self.batch_size)])
+
+    def predict(self, batch):
+        """
+        Class probabilities, shape (N, 1000)
+        """
+        return softmax(self.logits(batch))
+
+    def predict_top_k(self, batch, k = 5):
+        """
+        The k most likely classes of every image, as (indices, probs) arrays
+        of shape (N, k) sorted by decreasing probability
+        """
+        return top_k(self.predict(batch), k)
+
+
+def main():
+    parser = argparse.ArgumentParser(description = 'TensorFlow-free AlexNet inference')
+    parser.add_argument('images', nargs = '+')
+    parser.add_argument('--weights', default = None)
+    parser.add_argument('--compare', action = 'store_true',
+                        help = 'also run AlexNetPredictor and report the max difference')
+    args = parser.parse_args()
+
+    t = time.time()
+    net = NumpyAlexNet(args.weights)
+    batch = np.stack([load_image(path) for path in args.images])
+    print('start-up {:.1f} ms'.format((time.time() - t) * 1000.))
+
+    t = time.time()
+    prob = net.predict(batch)
+    print('forward {:.1f} ms'.format((time.time() - t) * 1000.))
+    inds, probs = top_k(prob, 5)
+    names = class_name_array[inds]
+    for input_im_ind in range(inds.shape[0]):
+        print("Image", input_im_ind)
+        for i in range(5):
+            print(names[input_im_ind, i], probs[input_im_ind, i])
+
+    if args.compare:
+        from alexnet_predictor import AlexNetPredictor
+        predictor = AlexNetPredictor(net.WEIGHTS_PATH)
+        print('max |prob - tf prob| = {}'.format(np.abs(prob - predictor.predict(batch)).max()))
+        predictor.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,110 @@
+################################################################################
+#Post-training int8 quantization of AlexNet
+#
+#A sample of images runs through the float32 graph of alexnet_predictor to
+#record the range of every layer input. The weights are quantized to int8 with
+#one scale per output channel and written together with the input scales, see
+#weight_store.save_quantized. AlexNetPredictor runs such a file with quantized
+#conv/fc layers; the report compares its top-1/top-5 predictions on the
+#bundled images against the float32 model.
+#
+#usage: python quantize_alexnet.py bvlc_alexnet.npy bvlc_alexnet_int8.npz
+################################################################################
+
+import argparse
+import os
+
+import numpy as np
+import tensorflow as tf
+
+from alexnet_predictor import AlexNetPredictor, LAYER_NAMES, create_variables, forward
+from input_pipeline import preprocess_batch
+from weight_store import load_quantized, load_weights_dict, save_quantized
+
+SAMPLE_IMAGES = ['laska.png', 'poodle.png', 'dog.png', 'dog2.png', 'quail227.JPEG']
+
+def read_images(paths):
+    """
+    Encoded bytes of every image file
+    """
+    images = []
+    for path in paths:
+        with open(path, 'rb') as f:
+            images.append(f.read())
+    return images
+
+def calibrate(net_data, images, batch_size = 16, percentile = 100.):
+    """
+    Run encoded images through the float32 graph and return the int8 scale
+    {layer: range / 127} of every layer input. The range is the given
+    percentile of the per-batch maxima of |input|
+    """
+    graph = tf.Graph()
+    with graph.as_default():
+        encoded = tf.placeholder(tf.string, (None,))
+        variables, init_feed, _ = create_variables(net_data)
+        endpoints = {}
+        forward(preprocess_batch(encoded), variables, endpoints)
+        ranges = dict((name, tf.reduce_max(tf.abs(endpoints[name]))) for name in LAYER_NAMES)
+        with tf.Session(graph = graph) as sess:
+            sess.run(tf.global_variables_initializer(), feed_dict = init_feed)
+            maxima = dict((name, []) for name in LAYER_NAMES)
+            for start in range(0, len(images), batch_size):
+                batch_ranges = sess.run(ranges, feed_dict = {encoded: images[start:start + batch_size]})
+                for name in LAYER_NAMES:
+                    maxima[name].append(batch_ranges[name])
+    return dict((name, max(float(np.percentile(maxima[name], percentile)), 1e-8) / 127.)
+                for name in LAYER_NAMES)
+
+def weights_nbytes(weights_dict):
+    """
+    Bytes of all arrays of a {layer: [weights, biases]} dict, where quantized
+    weights are (int8 weights, scales) pairs
+    """
+    return sum(np.asarray(a).nbytes for tensors in weights_dict.values()
+               for data in tensors for a in (data if isinstance(data, tuple) else [data]))
+
+def agreement(reference, candidate, images, k = 5):
+    """
+    How well candidate reproduces the predictions of reference on encoded
+    images: the fraction of identical top-1 classes, of reference top-1
+    classes inside the candidate top-k, and the mean top-k overlap
+    """
+    ref_inds, _ = reference.predict_top_k_encoded(images, k)
+    cand_inds, _ = candidate.predict_top_k_encoded(images, k)
+    top1 = np.mean(ref_inds[:, 0] == cand_inds[:, 0])
+    top1_in_k = np.mean([ref[0] in cand for ref, cand in zip(ref_inds, cand_inds)])
+    overlap = np.mean([len(set(ref) & set(cand)) / float(k) for ref, cand in zip(ref_inds, cand_inds)])
+    return {'top1': float(top1), 'top1_in_top{}'.format(k): float(top1_in_k),
+            'top{}_overlap'.format(k): float(overlap)}
+
+def main():
+    parser = argparse.ArgumentParser(description = 'int8 post-training quantization of AlexNet')
+    parser.add_argument('weights', help = 'float32 weights, any format of weight_store')
+    parser.add_argument('out', help = 'int8 .npz to write')
+    parser.add_argument('--calibration', nargs = '+', default = SAMPLE_IMAGES,
+                        help = 'images to calibrate the activation ranges on')
+    parser.add_argument('--eval', nargs = '+', default = SAMPLE_IMAGES,
+                        help = 'images to compare float32 and int8 predictions on')
+    parser.add_argument('--percentile', type = float, default = 100.)
+    args = parser.parse_args()
+
+    net_data = load_weights_dict(args.weights)
+    input_scales = calibrate(net_data, read_images(args.calibration), percentile = args.percentile)
+    save_quantized(net_data, input_scales, args.out)
+    print('input scales: {}'.format(input_scales))
+    print('weights: {:.1f} MB float32 -> {:.1f} MB int8 ({:.1f} MB on disk)'.format(
+        weights_nbytes(net_data) / 2.**20, weights_nbytes(load_quantized(args.out)[0]) / 2.**20,
+        os.path.getsize(args.out) / 2.**20))
+    del net_data
+
+    reference = AlexNetPredictor(args.weights)
+    quantized = AlexNetPredictor(args.out)
+    print('agreement with float32 on {} images: {}'.format(
+        len(args.eval), agreement(reference, quantized, read_images(args.eval))))
+    reference.close()
+    quantized.close()
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+################################################################################
+#Half precision AlexNet weights
+#
+#Converts the float32 weights into a float16 or bfloat16 .weights container
+#(see weight_store.write_weights) and reports how far the logits move on the
+#bundled images, both when the container is upcast to float32 on load and
+#when the fc weights are also kept in reduced precision inside the graph.
+#Either way the arithmetic is float32: the container halves the file and the
+#page cache. The in-graph mode also lowers the idle session memory, but every
+#run casts the fc weights to a float32 copy, so peak memory and latency are
+#higher than with the weights upcast on load.
+#
+#usage: python reduced_precision.py bvlc_alexnet.npy bvlc_alexnet_fp16.weights float16
+################################################################################
+
+import argparse
+import os
+
+import numpy as np
+
+from alexnet_predictor import AlexNetPredictor
+from quantize_alexnet import SAMPLE_IMAGES, read_images
+from weight_store import BFLOAT16, convert
+
+def logit_deviation(reference, candidate, images):
+    """
+    Max absolute logit difference and top-1 agreement of candidate against
+    reference on encoded images
+    """
+    ref_logits = reference.predict_logits_encoded(images)
+    cand_logits = candidate.predict_logits_encoded(images)
+    return {'max_logit_deviation': float(np.abs(ref_logits - cand_logits).max()),
+            'top1': float(np.mean(ref_logits.argmax(1) == cand_logits.argmax(1)))}
+
+def main():
+    parser = argparse.ArgumentParser(description = 'float16/bfloat16 AlexNet weights')
+    parser.add_argument('weights', help = 'float32 weights, any format of weight_store')
+    parser.add_argument('out', help = '.weights container to write')
+    parser.add_argument('dtype', choices = ['float16', BFLOAT16])
+    parser.add_argument('--eval', nargs = '+', default = SAMPLE_IMAGES,
+                        help = 'images to compare the logits on')
+    args = parser.parse_args()
+
+    convert(args.weights, args.out, args.dtype if args.dtype == BFLOAT16 else np.float16)
+    print('{}: {:.1f} MB -> {:.1f} MB'.format(args.dtype, os.path.getsize(args.weights) / 2.**20,
+                                             os.path.getsize(args.out) / 2.**20))
+
+    images = read_images(args.eval)
+    reference = AlexNetPredictor(args.weights)
+    for name, fc_dtype in [('upcast on load', None), ('fc in ' + args.dtype, args.dtype)]:
+        candidate = AlexNetPredictor(args.out, fc_dtype = fc_dtype)
+        print('{}: {}'.format(name, logit_deviation(reference, candidate, images)))
+        candidate.close()
+    reference.close()
+
+
+if __name__ == '__main__':
+    main()
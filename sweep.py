@@ -0,0 +1,222 @@
+import argparse
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import pickle
+
+import numpy as np
+
+"""
+Parallel driver for the prune -> retrain -> test schedule of run.py.
+
+A sweep is a list of chains. The cRates configurations of one chain depend on
+each other (every step starts from the masks the previous step left in
+parent_dir) and run in order in one worker; different chains are independent
+and run side by side in a process pool, each worker with its own thread
+budget. Every finished step is appended to a JSON lines state file, so a
+crashed sweep picks up where it stopped, and the results are written as a
+CSV table of accuracy and per-layer sparsity.
+"""
+
+def grid(base, values):
+    """
+    Expand {key: [values]} around a base cRates dict into one single-step
+    chain per combination
+    """
+    keys = sorted(values)
+    chains = []
+    for combo in itertools.product(*[values[key] for key in keys]):
+        crates = dict(base)
+        crates.update(zip(keys, combo))
+        chains.append([crates])
+    return chains
+
+def learning_rate(iter_cnt):
+    if (iter_cnt > 3 and iter_cnt < 5):
+        return 5e-5
+    elif (iter_cnt >= 5):
+        return 1e-5
+    return 1e-4
+
+def layer_sparsity(mask_file):
+    """
+    Fraction of pruned weights per layer from a mask pickle
+    """
+    from weight_mask import PackedMask
+    if not os.path.exists(mask_file):
+        return {}
+    with open(mask_file, 'rb') as f:
+        (weights_mask, _) = pickle.load(f)
+    sparsity = {}
+    for key, mask in weights_mask.items():
+        if isinstance(mask, PackedMask):
+            sparsity[key] = 1. - mask.count() / float(mask.size)
+        else:
+            sparsity[key] = 1. - np.count_nonzero(mask) / float(np.size(mask))
+    return sparsity
+
+def run_step(crates, parent_dir, num_threads, prev_crates = None, with_biases = False,
+             max_iter = 7, target_acc = 0.823):
+    """
+    One cRates configuration: prune, retrain and test until the accuracy
+    target is met or max_iter rounds are used up. The first prune starts from
+    the state saved under prev_crates, or from bvlc_alexnet without one
+    """
+    import tensorflow as tf
+    import alexnet_training
+
+    def run(param):
+        # every main() builds its model into the default graph
+        tf.reset_default_graph()
+        try:
+            return alexnet_training.main(param)
+        except SystemExit as e:
+            # would take the pool worker down and leave the sweep waiting
+            raise RuntimeError('alexnet_training.main exited: {}'.format(e))
+
+    acc = None
+    for iter_cnt in range(max_iter):
+        lr = learning_rate(iter_cnt)
+        if (iter_cnt > 0):
+            state = [('-first_time', False)]
+        elif (prev_crates is None):
+            state = [('-first_time', True)]
+        else:
+            state = [('-first_time', False),
+                     ('-save', True),
+                     ('-org_file_name', alexnet_training.compute_file_name(prev_crates))]
+        common = [
+            ('-cRates', crates),
+            ('-first_time', False),
+            ('-lr', lr),
+            ('-with_biases', with_biases),
+            ('-parent_dir', parent_dir),
+            ('-lambda1', 1e-5),
+            ('-lambda2', 1e-5),
+            ('-num_threads', num_threads)
+            ]
+        # later options win, state overrides -first_time of common
+        run(common + state + [('-train', False), ('-prune', True)])
+        run(common + [('-train', True), ('-prune', False)])
+        acc = run(common + [('-train', False), ('-prune', False), ('-test', True)])
+        if (acc is not None and acc > target_acc):
+            break
+    return acc, iter_cnt + 1
+
+# read by the BLAS libraries once, when numpy is first imported
+THREAD_VARS = ['OMP_NUM_THREADS', 'MKL_NUM_THREADS', 'OPENBLAS_NUM_THREADS']
+
+def _run_chain(args):
+    from alexnet_training import compute_file_name
+    chain_id, chain, done, parent_dir, num_threads, state_file, lock = args
+    results = []
+    for step, crates in enumerate(chain):
+        if step in done:
+            continue
+        prev_crates = chain[step - 1] if step > 0 else None
+        acc, iters = run_step(crates, parent_dir, num_threads, prev_crates)
+        mask_file = os.path.join(parent_dir, 'mask' + compute_file_name(crates) + '.pkl')
+        record = {'chain': chain_id, 'step': step, 'cRates': crates, 'accuracy': acc,
+                  'iterations': iters, 'sparsity': layer_sparsity(mask_file)}
+        # checkpoint every finished step
+        with lock:
+            with open(state_file, 'a') as f:
+                f.write(json.dumps(record) + '\n')
+        results.append(record)
+    return results
+
+def load_state(state_file):
+    """
+    Records of the steps finished so far
+    """
+    records = []
+    if os.path.exists(state_file):
+        with open(state_file) as f:
+            for line in f:
+                line = line.strip()
+                # a crash can leave a truncated last line
+                try:
+                    records.append(json.loads(line))
+                except ValueError:
+                    pass
+    return records
+
+def write_results(records, results_file):
+    """
+    CSV table: chain, step, the cRates, accuracy and sparsity per layer
+    """
+    rate_keys = sorted(set(k for r in records for k in r['cRates']))
+    layer_keys = sorted(set(k for r in records for k in r['sparsity']))
+    with open(results_file, 'w') as f:
+        writer = csv.writer(f)
+        writer.writerow(['chain', 'step'] + ['rate_' + k for k in rate_keys] +
+                        ['accuracy', 'iterations'] + ['sparsity_' + k for k in layer_keys])
+        for r in sorted(records, key = lambda r: (r['chain'], r['step'])):
+            writer.writerow([r['chain'], r['step']] + [r['cRates'].get(k) for k in rate_keys] +
+                            [r['accuracy'], r['iterations']] +
+                            [r['sparsity'].get(k) for k in layer_keys])
+
+def run_sweep(chains, parent_dir, workers = 2, threads_per_worker = None,
+              state_file = 'sweep_state.jsonl', results_file = 'sweep_results.csv'):
+    """
+    Run the chains in a pool of workers, skipping steps recorded in
+    state_file, and write the results table
+    """
+    if threads_per_worker is None:
+        threads_per_worker = max(1, multiprocessing.cpu_count() // workers)
+
+    done = {}
+    for r in load_state(state_file):
+        done.setdefault(r['chain'], set()).add(r['step'])
+
+    # spawn, so that no worker inherits an initialized TensorFlow runtime
+    ctx = multiprocessing.get_context('spawn')
+    lock = ctx.Manager().Lock()
+    jobs = [(i, chain, done.get(i, set()), parent_dir, threads_per_worker, state_file, lock)
+            for i, chain in enumerate(chains) if len(done.get(i, ())) < len(chain)]
+    # a spawned worker imports numpy (this module) before any initializer
+    # runs, so the thread budget has to be in the environment it inherits,
+    # for the replacement workers of maxtasksperchild too
+    saved_env = dict((var, os.environ.get(var)) for var in THREAD_VARS)
+    os.environ.update((var, str(threads_per_worker)) for var in THREAD_VARS)
+    try:
+        pool = ctx.Pool(workers, maxtasksperchild = 1)
+        try:
+            for _ in pool.imap_unordered(_run_chain, jobs):
+                write_results(load_state(state_file), results_file)
+        finally:
+            pool.close()
+            pool.join()
+    finally:
+        for var, value in saved_env.items():
+            if value is None:
+                os.environ.pop(var, None)
+            else:
+                os.environ[var] = value
+
+    records = load_state(state_file)
+    write_results(records, results_file)
+    return records
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description = 'parallel pruning sweep')
+    parser.add_argument('--parent_dir', default = 'assets/')
+    parser.add_argument('--workers', type = int, default = 2)
+    parser.add_argument('--threads', type = int, default = None, help = 'threads per worker')
+    parser.add_argument('--grid', action = 'append', default = [],
+                        help = 'layer=v1,v2,... (repeatable), e.g. fc6=1.7,1.8,1.9')
+    parser.add_argument('--state', default = 'sweep_state.jsonl')
+    parser.add_argument('--results', default = 'sweep_results.csv')
+    args = parser.parse_args()
+
+    base = {'conv1': 0., 'conv2': 0., 'conv3': 0., 'conv4': 0., 'conv5': 0.,
+            'fc6': 1.70, 'fc7': 0., 'fc8': 0.}
+    values = {}
+    for spec in args.grid:
+        key, vals = spec.split('=')
+        values[key] = [float(v) for v in vals.split(',')]
+    run_sweep(grid(base, values), args.parent_dir, args.workers, args.threads,
+              args.state, args.results)
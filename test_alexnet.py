@@ -0,0 +1,33 @@
+import numpy as np
+import pytest
+
+tf = pytest.importorskip('tensorflow')
+
+from alexnet import AlexNet
+from weight_mask import PackedMask
+
+def test_mask_weights_round_trip():
+    # masks of a later run are loaded into the bool weights_mask variables
+    graph = tf.Graph()
+    with graph.as_default():
+        x = tf.placeholder(tf.float32, [None, 227, 227, 3])
+        keep_prob = tf.placeholder(tf.float32)
+        model = AlexNet(x, keep_prob, 10)
+        variables = model.mask_variables()
+        shapes = dict((name, var.get_shape().as_list()) for name, var in variables.items())
+
+        rng = np.random.RandomState(0)
+        masks = {'conv2': rng.rand(*shapes['conv2']) > 0.5,
+                 'fc7': PackedMask.from_array(rng.rand(*shapes['fc7']) > 0.3)}
+        with tf.Session() as sess:
+            sess.run(tf.global_variables_initializer())
+            model.mask_weights(masks, sess)
+            # loading twice reuses the cached assign ops
+            model.mask_weights(masks, sess)
+            loaded = sess.run(variables)
+
+    assert loaded['conv2'].dtype == np.bool_
+    np.testing.assert_array_equal(loaded['conv2'], masks['conv2'])
+    np.testing.assert_array_equal(loaded['fc7'], masks['fc7'].unpack())
+    # layers without a mask keep every weight
+    assert loaded['fc6'].all()
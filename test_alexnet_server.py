@@ -0,0 +1,133 @@
+import asyncio
+import io
+import json
+
+import numpy as np
+
+from alexnet_server import InferenceServer, MicroBatcher
+
+class StubPredictor(object):
+    """
+    Stands in for AlexNetPredictor: the top class of an image is the value
+    of its first pixel, every call records its batch size
+    """
+    def __init__(self, fail = False):
+        self.fail = fail
+        self.batch_sizes = []
+
+    def predict_top_k_encoded(self, images, k = 5):
+        # the "encoded image" is the class id as text, b'bad' cannot be decoded
+        if b'bad' in images:
+            raise ValueError('corrupt image')
+        return self.predict_top_k(np.array([int(i) for i in images])[:, None, None, None], k)
+
+    def predict_top_k(self, batch, k = 5):
+        self.batch_sizes.append(len(batch))
+        if self.fail:
+            raise RuntimeError('predictor failed')
+        first = np.asarray(batch)[:, 0, 0, 0].astype(np.int64)
+        inds = (first[:, None] + np.arange(k)) % 1000
+        probs = np.tile(np.linspace(0.5, 0.1, k), (len(batch), 1))
+        return inds, probs
+
+def npy_body(value):
+    buf = io.BytesIO()
+    np.save(buf, np.full((227, 227, 3), value, dtype = np.float32))
+    return buf.getvalue()
+
+async def request(port, method, path, body = b'', headers = None):
+    """
+    One HTTP/1.1 request on a fresh connection, returns (status code, JSON)
+    """
+    reader, writer = await asyncio.open_connection('127.0.0.1', port)
+    headers = dict({'Content-Length': len(body)}, **(headers or {}))
+    head = '{} {} HTTP/1.1\r\nConnection: close\r\n'.format(method, path)
+    for name, value in headers.items():
+        head += '{}: {}\r\n'.format(name, value)
+    writer.write(head.encode('latin1') + b'\r\n' + body)
+    await writer.drain()
+    response = await reader.read()
+    writer.close()
+    head, _, payload = response.partition(b'\r\n\r\n')
+    return int(head.split(b' ')[1]), json.loads(payload.decode('utf-8'))
+
+def serve(predictor, test, **kwargs):
+    """
+    Run the coroutine test(port) against a server on an ephemeral port
+    """
+    async def run():
+        batcher = MicroBatcher(predictor, max_batch_size = 8, max_latency = 0.05, k = 3)
+        encoded_batcher = MicroBatcher(predictor, max_batch_size = 8, max_latency = 0.05, k = 3,
+                                       encoded = True)
+        server = InferenceServer(batcher, encoded_batcher = encoded_batcher, **kwargs)
+        await server.start('127.0.0.1', 0)
+        port = server.server.sockets[0].getsockname()[1]
+        try:
+            return await test(port)
+        finally:
+            await server.stop()
+    return asyncio.run(run())
+
+def test_concurrent_requests_share_a_batch():
+    predictor = StubPredictor()
+
+    async def test(port):
+        return await asyncio.gather(*[request(port, 'POST', '/predict', npy_body(i))
+                                      for i in range(5)])
+
+    responses = serve(predictor, test)
+    for i, (status, payload) in enumerate(responses):
+        assert status == 200
+        assert payload['classes'] == [i, i + 1, i + 2]
+    assert predictor.batch_sizes == [5]
+
+def test_bad_image_fails_only_its_own_request():
+    predictor = StubPredictor()
+
+    async def test(port):
+        return await asyncio.gather(*[request(port, 'POST', '/predict', body,
+                                              {'Content-Type': 'image/jpeg'})
+                                      for body in [b'7', b'bad', b'9']])
+
+    (ok1, payload1), (failed, _), (ok2, payload2) = serve(predictor, test)
+    assert (ok1, ok2, failed) == (200, 200, 500)
+    assert payload1['classes'][0] == 7 and payload2['classes'][0] == 9
+    # the shared batch failed, then every image was retried on its own
+    assert predictor.batch_sizes == [1, 1]
+
+def test_predictor_error_is_500():
+    async def test(port):
+        return await request(port, 'POST', '/predict', npy_body(0))
+
+    status, payload = serve(StubPredictor(fail = True), test)
+    assert status == 500
+    assert 'predictor failed' in payload['error']
+
+def test_bad_input_is_400():
+    async def test(port):
+        return (await request(port, 'POST', '/predict', b'not an array'),
+                await request(port, 'POST', '/predict', npy_body(0)[:-10]),
+                await request(port, 'POST', '/predict', b'', {'Content-Length': 'x'}))
+
+    for status, payload in serve(StubPredictor(), test):
+        assert status == 400
+        assert 'error' in payload
+
+def test_large_body_is_413():
+    async def test(port):
+        # refused on the headers alone, the body is never sent
+        return await request(port, 'POST', '/predict', b'', {'Content-Length': 10**9})
+
+    status, _ = serve(StubPredictor(), test, max_body_size = 1024)
+    assert status == 413
+
+def test_metrics_and_unknown_endpoint():
+    async def test(port):
+        await request(port, 'POST', '/predict', npy_body(1))
+        return (await request(port, 'GET', '/metrics'),
+                await request(port, 'GET', '/nothing'))
+
+    (status, metrics), (missing, _) = serve(StubPredictor(), test)
+    assert status == 200
+    assert metrics['requests'] == 1
+    assert missing == 404
@@ -0,0 +1,130 @@
+import numpy as np
+
+"""
+Compact pruning masks. A PackedMask stores one bit per weight (np.packbits),
+so the fc6 mask is 4.7 MB instead of the 300 MB of an int64/float64 array,
+and it is applied to weight or gradient arrays in place, chunk by chunk,
+without ever expanding the whole mask.
+"""
+
+# bits unpacked per step of the chunked apply (1M weights)
+CHUNK_BITS = 2**20
+
+# number of set bits of every byte value
+POPCOUNT = np.array([bin(i).count('1') for i in range(256)], dtype = np.uint8)
+
+class PackedMask(object):
+  def __init__(self, bits, shape):
+    # -bits: np.packbits of the flattened bool mask
+    self.bits = bits
+    self.shape = tuple(shape)
+    self.size = int(np.prod(self.shape))
+
+  @classmethod
+  def from_array(cls, mask):
+    """
+    Pack any array whose non-zero entries mark the kept weights
+    """
+    mask = np.asarray(mask)
+    return cls(np.packbits(mask.ravel() != 0), mask.shape)
+
+  @classmethod
+  def ones(cls, shape):
+    """
+    A mask that keeps every weight
+    """
+    size = int(np.prod(shape))
+    bits = np.full((size + 7) // 8, 255, dtype = np.uint8)
+    # clear the padding bits of the last byte so count() stays exact
+    if size % 8:
+      bits[-1] = np.uint8((0xff << (8 - size % 8)) & 0xff)
+    return cls(bits, shape)
+
+  def unpack(self):
+    """
+    The full bool mask
+    """
+    return np.unpackbits(self.bits, count = self.size).view(np.bool_).reshape(self.shape)
+
+  def count(self):
+    """
+    Number of kept weights
+    """
+    return int(POPCOUNT[self.bits].sum(dtype = np.int64))
+
+  def apply(self, array):
+    """
+    Zero the pruned entries of a weight or gradient array in place
+    """
+    if not array.flags.c_contiguous:
+      raise ValueError('masks can only be applied in place to contiguous arrays')
+    flat = array.reshape(-1)
+    for start in range(0, self.size, CHUNK_BITS):
+      stop = min(start + CHUNK_BITS, self.size)
+      chunk = np.unpackbits(self.bits[start // 8:(stop + 7) // 8], count = stop - start)
+      np.multiply(flat[start:stop], chunk.view(np.bool_), out = flat[start:stop])
+    return array
+
+  def __and__(self, other):
+    return PackedMask(np.bitwise_and(self.bits, other.bits), self.shape)
+
+  def __or__(self, other):
+    return PackedMask(np.bitwise_or(self.bits, other.bits), self.shape)
+
+def chunked_mean_std(array, chunk = CHUNK_BITS):
+  """
+  Mean and standard deviation of an array in a single pass over chunks,
+  merging the per-chunk statistics (Chan et al.) so that no full-size
+  temporaries are created
+  """
+  flat = array.reshape(-1)
+  n = 0
+  mean = 0.
+  m2 = 0.
+  for start in range(0, flat.size, chunk):
+    block = flat[start:start + chunk].astype(np.float64)
+    n_b = block.size
+    mean_b = block.mean()
+    m2_b = np.square(block - mean_b).sum()
+    delta = mean_b - mean
+    total = n + n_b
+    mean += delta * n_b / total
+    m2 += m2_b + delta * delta * n * n_b / total
+    n = total
+  return mean, np.sqrt(m2 / n)
+
+def prune_mask(mask, weights, threshold_off, threshold_on):
+  """
+  Dynamic network surgery update of a PackedMask in place: weights with
+  |w| < threshold_off are cut, weights with |w| > threshold_on are spliced
+  back in, everything in between keeps its current state. Works chunk by
+  chunk, the only full-size array is the weights being read
+  """
+  flat = weights.reshape(-1)
+  for start in range(0, mask.size, CHUNK_BITS):
+    stop = min(start + CHUNK_BITS, mask.size)
+    byte_slice = slice(start // 8, (stop + 7) // 8)
+    keep = np.unpackbits(mask.bits[byte_slice], count = stop - start).view(np.bool_)
+    magnitude = np.abs(flat[start:stop])
+    keep &= magnitude >= threshold_off
+    keep |= magnitude > threshold_on
+    mask.bits[byte_slice] = np.packbits(keep)
+  return mask
+
+def as_bool(mask):
+  """
+  bool view of a PackedMask, bool array or legacy int/float mask
+  """
+  if isinstance(mask, PackedMask):
+    return mask.unpack()
+  mask = np.asarray(mask)
+  if mask.dtype == np.bool_:
+    return mask
+  return mask != 0
+
+def pack_masks(masks):
+  """
+  Pack a {layer: mask} dict, e.g. one loaded from an old int64 mask pickle
+  """
+  return dict((key, mask if isinstance(mask, PackedMask) else PackedMask.from_array(mask))
+              for key, mask in masks.items())
@@ -0,0 +1,359 @@
+import json
+import os
+import struct
+import sys
+
+import numpy as np
+
+"""
+Weight file formats for AlexNet. All loaders return the same
+{layer: [weights, biases]} dict as the pickled bvlc_alexnet.npy, but the
+flat formats hand out read-only memory-mapped views instead of private
+copies, so several processes on one host share a single copy of the weights
+in the page cache.
+
+The single-file container (.weights) is laid out as
+  b'ALXW' | uint64 header length | JSON header | tensor data
+where the header lists layer, name, dtype, shape and byte offset of every
+tensor and each tensor starts on an ALIGNMENT byte boundary. Containers can
+hold float16 or bfloat16 tensors (half the size on disk and in the page
+cache), which are upcast to float32 tensor by tensor when they are read.
+"""
+
+LAYER_NAMES = ['conv1', 'conv2', 'conv3', 'conv4', 'conv5', 'fc6', 'fc7', 'fc8']
+
+MAGIC = b'ALXW'
+ALIGNMENT = 64
+VAR_NAMES = ['weights', 'biases']
+# numpy has no bfloat16, such tensors are stored as their raw uint16 bits
+BFLOAT16 = 'bfloat16'
+
+def _var_name(data):
+  return 'biases' if len(data.shape) == 1 else 'weights'
+
+def _align(offset):
+  return (offset + ALIGNMENT - 1) // ALIGNMENT * ALIGNMENT
+
+def to_bfloat16(array):
+  """
+  Round a float32 array to bfloat16 (to nearest even), as uint16 bits
+  """
+  bits = np.ascontiguousarray(array, dtype = np.float32).view(np.uint32)
+  rounded = (bits + np.uint32(0x7fff) + ((bits >> 16) & 1)) >> 16
+  # rounding must not turn a NaN into an infinity
+  return np.where(np.isnan(array), np.uint16(0x7fc0), rounded.astype(np.uint16))
+
+def from_bfloat16(bits):
+  """
+  float32 array from the uint16 bits written by to_bfloat16
+  """
+  return (np.asarray(bits, dtype = np.uint32) << 16).view(np.float32)
+
+def write_weights(weights_dict, path, dtype = np.float32):
+  """
+  Write a {layer: [weights, biases]} dict into a single aligned container,
+  with all tensors stored as dtype (float32, float16 or BFLOAT16)
+  """
+  tensors = []
+  arrays = []
+  for op_name in sorted(weights_dict):
+    for data in weights_dict[op_name]:
+      if dtype == BFLOAT16:
+        data = to_bfloat16(data)
+        dtype_name = BFLOAT16
+      else:
+        data = np.ascontiguousarray(data, dtype = dtype)
+        dtype_name = data.dtype.str
+      tensors.append({'layer': op_name, 'name': _var_name(data),
+                      'dtype': dtype_name, 'shape': list(data.shape)})
+      arrays.append(data)
+
+  # offsets depend on the header size, which depends on the offsets, so
+  # size the header with placeholder offsets first and pad it generously
+  for t in tensors:
+    t['offset'] = 2**40
+  header_len = _align(len(json.dumps({'tensors': tensors})) + 12 + ALIGNMENT) - 12
+  offset = 12 + header_len
+  for t, data in zip(tensors, arrays):
+    offset = _align(offset)
+    t['offset'] = offset
+    offset += data.nbytes
+  header = json.dumps({'tensors': tensors}).encode('utf-8').ljust(header_len)
+
+  with open(path, 'wb') as f:
+    f.write(MAGIC)
+    f.write(struct.pack('<Q', header_len))
+    f.write(header)
+    for t, data in zip(tensors, arrays):
+      f.write(b'\0' * (t['offset'] - f.tell()))
+      f.write(data.tobytes())
+
+def read_weights(path, upcast = True):
+  """
+  Map a container written by write_weights, every float32 tensor is a
+  zero-copy view into the shared mapping. Reduced precision tensors are
+  upcast to float32 one by one, or with upcast=False float16 tensors stay
+  float16 views (bfloat16 ones are always upcast)
+  """
+  blob = np.memmap(path, dtype = np.uint8, mode = 'r')
+  if blob[:4].tobytes() != MAGIC:
+    raise ValueError('{} is not an AlexNet weight container'.format(path))
+  header_len = struct.unpack('<Q', blob[4:12].tobytes())[0]
+  header = json.loads(blob[12:12 + header_len].tobytes().decode('utf-8'))
+
+  weights_dict = {}
+  for t in header['tensors']:
+    dtype = np.dtype(np.uint16 if t['dtype'] == BFLOAT16 else t['dtype'])
+    nbytes = int(np.prod(t['shape'])) * dtype.itemsize
+    data = blob[t['offset']:t['offset'] + nbytes].view(dtype).reshape(t['shape'])
+    if t['dtype'] == BFLOAT16:
+      data = from_bfloat16(data)
+    elif upcast and data.dtype != np.float32:
+      data = data.astype(np.float32)
+    weights_dict.setdefault(t['layer'], {})[t['name']] = data
+  return _as_lists(weights_dict)
+
+def _as_lists(weights_dict):
+  """
+  {layer: {name: array}} -> {layer: [weights, biases]}
+  """
+  return dict((op_name, [tensors[v] for v in VAR_NAMES if v in tensors])
+              for op_name, tensors in weights_dict.items())
+
+def save_weights_dir(weights_dict, weights_dir):
+  """
+  Write a {layer: [weights, biases]} dict as one plain .npy file per tensor
+  (<layer>_weights.npy, <layer>_biases.npy) so that it can be memory-mapped
+  """
+  if not os.path.exists(weights_dir):
+    os.makedirs(weights_dir)
+  for op_name in weights_dict:
+    for data in weights_dict[op_name]:
+      np.save(os.path.join(weights_dir, op_name + '_' + _var_name(data) + '.npy'),
+              np.ascontiguousarray(data, dtype = np.float32))
+
+def load_weights_dir(weights_dir):
+  """
+  Memory-map every tensor of a directory written by save_weights_dir
+  """
+  weights_dict = {}
+  for f_name in os.listdir(weights_dir):
+    if f_name.endswith('.npy'):
+      op_name, var_name = f_name[:-len('.npy')].rsplit('_', 1)
+      weights_dict.setdefault(op_name, {})[var_name] = np.load(
+        os.path.join(weights_dir, f_name), mmap_mode = 'r')
+  return _as_lists(weights_dict)
+
+def encode_relative(weights, max_step = 255):
+  """
+  Encode the non-zero entries of an array as uint8 steps between consecutive
+  flat positions plus their values. Gaps longer than max_step are bridged
+  with filler entries of value 0
+  """
+  flat = np.asarray(weights).ravel()
+  positions = np.flatnonzero(flat)
+  gaps = np.diff(positions, prepend = -1)
+  n_fill = (gaps - 1) // max_step
+
+  # slot of every real entry once the fillers are inserted in front of it
+  slots = np.arange(len(positions)) + np.cumsum(n_fill)
+  steps = np.full(len(positions) + int(n_fill.sum()), max_step, dtype = np.uint8)
+  values = np.zeros(len(steps), dtype = np.float32)
+  steps[slots] = gaps - n_fill * max_step
+  values[slots] = flat[positions]
+  return steps, values
+
+def decode_positions(steps):
+  """
+  Flat positions of the entries encoded by encode_relative
+  """
+  return np.cumsum(steps, dtype = np.int64) - 1
+
+def quantize(values, bits, iterations = 10):
+  """
+  1-D k-means over the non-zero values with 2**bits - 1 centroids,
+  initialized linearly. Code 0 is reserved for exact zeros (the fillers).
+  Returns uint8 codes and the float32 codebook
+  """
+  if not 1 <= bits <= 8:
+    raise ValueError('codebook bits must be between 1 and 8, the codes are uint8, got {}'.format(bits))
+  codebook = np.zeros(2**bits, dtype = np.float32)
+  nonzero = values != 0
+  if not nonzero.any():
+    return np.zeros(len(values), dtype = np.uint8), codebook
+  centroids = np.linspace(values[nonzero].min(), values[nonzero].max(), 2**bits - 1)
+  for _ in range(iterations):
+    # nearest centroid through the midpoints of the sorted centroids
+    assign = np.searchsorted((centroids[1:] + centroids[:-1]) / 2, values[nonzero])
+    sums = np.bincount(assign, weights = values[nonzero], minlength = len(centroids))
+    counts = np.bincount(assign, minlength = len(centroids))
+    centroids = np.where(counts > 0, sums / np.maximum(counts, 1), centroids)
+    centroids.sort()
+  codes = np.zeros(len(values), dtype = np.uint8)
+  codes[nonzero] = np.searchsorted((centroids[1:] + centroids[:-1]) / 2, values[nonzero]) + 1
+  codebook[1:] = centroids
+  return codes, codebook
+
+def save_pruned(weights_dict, path, codebook_bits = None):
+  """
+  Write a pruned {layer: [weights, biases]} dict keeping only the surviving
+  weights, as relative uint8 indices plus float32 values or, with
+  codebook_bits (<= 8), plus codes into a per-layer k-means codebook. The
+  mask is implicit in the stored positions. Biases are kept dense
+  """
+  arrays = {}
+  for op_name in weights_dict:
+    for data in weights_dict[op_name]:
+      if _var_name(data) == 'biases':
+        arrays[op_name + '.biases'] = np.asarray(data, dtype = np.float32)
+        continue
+      steps, values = encode_relative(data)
+      arrays[op_name + '.shape'] = np.array(data.shape, dtype = np.int64)
+      arrays[op_name + '.steps'] = steps
+      if codebook_bits:
+        arrays[op_name + '.codes'], arrays[op_name + '.codebook'] = quantize(values, codebook_bits)
+      else:
+        arrays[op_name + '.values'] = values
+  np.savez(path, **arrays)
+
+def load_pruned(path, sparse = False):
+  """
+  Load a file written by save_pruned as {layer: [weights, biases]}. With
+  sparse the weights come back as (indices, values, shape), the row-major
+  coordinates and values of the surviving entries, instead of a dense array
+  """
+  weights_dict = {}
+  with np.load(path) as arrays:
+    for key in arrays.files:
+      op_name, field = key.rsplit('.', 1)
+      weights_dict.setdefault(op_name, {})[field] = arrays[key]
+
+  for op_name, fields in weights_dict.items():
+    tensors = {'biases': fields['biases']}
+    if 'shape' in fields:
+      positions = decode_positions(fields['steps'])
+      if 'codes' in fields:
+        values = fields['codebook'][fields['codes']]
+      else:
+        values = fields['values']
+      shape = tuple(int(d) for d in fields['shape'])
+      if sparse:
+        keep = values != 0
+        indices = np.stack(np.unravel_index(positions[keep], shape), axis = 1)
+        tensors['weights'] = (indices, values[keep], shape)
+      else:
+        dense = np.zeros(int(np.prod(shape)), dtype = np.float32)
+        dense[positions] = values
+        tensors['weights'] = dense.reshape(shape)
+    weights_dict[op_name] = tensors
+  return _as_lists(weights_dict)
+
+def quantize_int8(weights):
+  """
+  Symmetric per-output-channel int8 quantization of a weight array whose
+  last axis holds the output channels (HWIO conv, (in, out) fc). Returns the
+  int8 array and the float32 scale of every channel
+  """
+  weights = np.asarray(weights, dtype = np.float32)
+  max_abs = np.abs(weights.reshape(-1, weights.shape[-1])).max(axis = 0)
+  scales = np.where(max_abs > 0, max_abs / 127., 1.).astype(np.float32)
+  return np.clip(np.round(weights / scales), -127, 127).astype(np.int8), scales
+
+def save_quantized(weights_dict, input_scales, path):
+  """
+  Write a {layer: [weights, biases]} dict with int8 weights, their
+  per-channel scales and the calibrated scale of every layer input
+  (input_scales, {layer: float}). Biases stay float32
+  """
+  arrays = {}
+  for op_name in weights_dict:
+    for data in weights_dict[op_name]:
+      if _var_name(data) == 'biases':
+        arrays[op_name + '.biases'] = np.asarray(data, dtype = np.float32)
+      else:
+        arrays[op_name + '.qweights'], arrays[op_name + '.scales'] = quantize_int8(data)
+    arrays[op_name + '.input_scale'] = np.float32(input_scales[op_name])
+  np.savez(path, **arrays)
+
+def is_quantized(path):
+  """
+  Whether an .npz weight file was written by save_quantized
+  """
+  with np.load(path) as arrays:
+    return any(key.endswith('.qweights') for key in arrays.files)
+
+def load_quantized(path):
+  """
+  Load a file written by save_quantized as {layer: [(int8 weights, scales),
+  biases]} and {layer: input scale}
+  """
+  weights_dict = {}
+  input_scales = {}
+  with np.load(path) as arrays:
+    for key in arrays.files:
+      op_name, field = key.rsplit('.', 1)
+      if field == 'input_scale':
+        input_scales[op_name] = float(arrays[key])
+      else:
+        weights_dict.setdefault(op_name, {})[field] = arrays[key]
+  return (dict((op_name, [(fields['qweights'], fields['scales']), fields['biases']])
+               for op_name, fields in weights_dict.items()),
+          input_scales)
+
+def dequantize(quantized_dict):
+  """
+  float32 {layer: [weights, biases]} from the result of load_quantized
+  """
+  return dict((op_name, [q.astype(np.float32) * scales, biases])
+              for op_name, ((q, scales), biases) in quantized_dict.items())
+
+def default_weights_path():
+  """
+  The memory-mapped container if it was converted, else the pickle
+  """
+  if os.path.exists('bvlc_alexnet.weights'):
+    return 'bvlc_alexnet.weights'
+  return 'bvlc_alexnet.npy'
+
+def load_weights_dict(weights_path, upcast = True):
+  """
+  Load a {layer: [weights, biases]} dict from any of the supported formats:
+  a .weights container or a directory of .npy files (both memory-mapped), a
+  pruned .npz written by save_pruned (expanded to dense), an int8 .npz
+  written by save_quantized (dequantized), or the pickled bvlc_alexnet.npy,
+  which has to be deserialized completely. upcast is passed on to
+  read_weights for half precision containers
+  """
+  if os.path.isdir(weights_path):
+    return load_weights_dir(weights_path)
+  if weights_path.endswith('.npz'):
+    if is_quantized(weights_path):
+      return dequantize(load_quantized(weights_path)[0])
+    return load_pruned(weights_path)
+  with open(weights_path, 'rb') as f:
+    magic = f.read(len(MAGIC))
+  if magic == MAGIC:
+    return read_weights(weights_path, upcast)
+  return np.load(weights_path, encoding = 'latin1', allow_pickle = True).item()
+
+def convert(npy_path, out_path, dtype = np.float32):
+  """
+  Convert the pickled bvlc_alexnet.npy (or any other supported format) into
+  a .weights container (of dtype float32, float16 or BFLOAT16), a pruned
+  .npz, or a directory of .npy files when out_path has neither extension
+  """
+  weights_dict = load_weights_dict(npy_path)
+  if dtype != np.float32 and not out_path.endswith('.weights'):
+    raise ValueError('only .weights containers can be stored in reduced precision')
+  if out_path.endswith('.weights'):
+    write_weights(weights_dict, out_path, dtype)
+  elif out_path.endswith('.npz'):
+    save_pruned(weights_dict, out_path)
+  else:
+    save_weights_dir(weights_dict, out_path)
+
+
+if __name__ == '__main__':
+  # usage: python weight_store.py bvlc_alexnet.npy bvlc_alexnet.weights [float16|bfloat16]
+  dtype = sys.argv[3] if len(sys.argv) > 3 else 'float32'
+  convert(sys.argv[1], sys.argv[2], dtype if dtype == BFLOAT16 else np.dtype(dtype))